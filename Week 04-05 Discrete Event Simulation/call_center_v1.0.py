@@ -19,8 +19,6 @@ to abandon the call if they wait too long.
 
 TODO: Fix tally class
 TODO: Significant refactoring for tons of repeated code
-TODO: Refactoring for trunk-line data - tie into call center
-TODO: Utilization charts - easier monitoring
 
 """
 
@@ -36,14 +34,26 @@ TODO: Utilization charts - easier monitoring
 # Libraries
 
 import simpy
+import math
 import random
+import itertools
+import time
 import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 from enum import Enum
 from datetime import datetime
-import math
 import matplotlib.pyplot as plt
+from des_runner import run_replications
+from des_monitor import LevelMonitor, MonitoredResource
+from des_sink import RecordSink, read_records
+from des_store import ExperimentStore
+from des_stats import kpi_confidence_intervals
+from des_random import RandomStreams, alias_transform
+from des_patience import PatienceTimers, CountingEnvironment
+from des_queueing import erlang_a, erlang_b
+from des_optimize import select_cheapest_feasible
+from des_cache import Checkpoint
 
 #####################################################
 # Classes
@@ -69,6 +79,7 @@ class RunParameters:
     author: str = "author"
     date_time: datetime = datetime.now()
     print_data: bool = False
+    workers: int = 1            # processes for replications, None = all cores
 
 # TODO
 # I need to figure out how to make these more like a data structure (attributes not vars)
@@ -114,177 +125,98 @@ class Customer(object):
             return call_center['Sales']                  # Order Status
 
     def start_call(self, call_center):
-         if self.status != CALL_STATUS[0]: 
-            # Available trunk line, Next step is start IVR
-            # Need a yield here due to how Simpy and generators work
-            # Can think of this as 2 second delay to pick up line/connect
-            yield self.env.timeout(0.04)
-            self.env.process(self.initial_IVR(call_center))
-         else:
-            yield self.env.timeout(0.04) # Busy signal and exit
-            
-    def initial_IVR(self, call_center):
+        # Can think of this as 2 second delay to pick up line/connect
+        # (or to hear the busy signal)
+        yield self.env.timeout(0.04)
+        if self.status == CALL_STATUS[0]:
+            return   # Busy signal and exit
+
+        # The whole call runs in this one process, stage by stage (see CALL_ROUTES)
+        for stage in CALL_ROUTES[self.call_type]:
+            if stage[0] == 'delay':
+                yield from self.ivr_stage(stage[1])
+            elif stage[0] == 'ivr':
+                yield from self.ivr_stage(random.triangular(stage[1][0],
+                                                            stage[1][1],
+                                                            stage[1][2]))
+            elif stage[0] == 'transfer':
+                # Transfer with probability stage[1], otherwise the call is done
+                if random.random() > stage[1]:
+                    self.end_call(CALL_STATUS[3])
+            elif stage[0] == 'agent':
+                yield from self.agent_stage(call_center, stage[1], stage[2], stage[3])
+            if self.status != CALL_STATUS[2]:
+                return
+        self.end_call(CALL_STATUS[3])
+
+    def ivr_stage(self, t_ivr):
         # Abandonment not considered during IVR phase, although in reality a customer could hang-up.
         # Could increase arrival rate to sieze trunk lines or consider non-abandoned arrival rate
         # Technically siezed trunk lines may matter even for 15 seconds, but simplifying assumption
- 
-        yield self.env.timeout(IVR_DELAY)
-        self.t_work_time += IVR_DELAY
-    
-        # Which queue will I eventually need
-        resource = self.pick_resource(call_center)        
-        
-        if self.call_type == SEGMENT_NAMES[0]:
-            self.env.process(self.start_tech_path(resource))
-        elif self.call_type == SEGMENT_NAMES[1]:
-            self.env.process(self.start_sales_call(call_center))
+        yield self.env.timeout(t_ivr)
+        self.t_work_time += t_ivr
+
+    def agent_stage(self, call_center, resource_name, call_time, close_rate):
+        # Which queue do I need (None = by tech segment)
+        if resource_name is None:
+            resource = self.pick_resource(call_center)
         else:
-            self.env.process(self.start_status_call(call_center))
-    
-    def start_tech_path(self, call_center_resource):
-        # Step 1, Automated System
-        yield self.env.timeout(IVR_DELAY)
-        self.t_work_time += IVR_DELAY
-        
-        # Start tech call
+            resource = call_center[resource_name]
         arrive = self.env.now
-        
-        with call_center_resource.request() as req:
-            results = yield req | self.env.timeout(self.patience)
-            
-            # Add in the wait time
-            self.t_wait_time += (self.env.now - arrive)
-            
-            # Determine if we got to the call or if we abandoned
-            if req in results:
-                # Made the call
-                t_call = random.triangular(CALL_TIME_TECH[0],
-                                           CALL_TIME_TECH[1],
-                                           CALL_TIME_TECH[2])
-                
-                # Have the call
-                yield self.env.timeout(t_call)
-                self.t_work_time += t_call
-                
-                # Call completed
-                self.status = CALL_STATUS[3] # Completed
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time   
-
-                # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1             
 
-            else:
-                # Customer abandoned the call, waited too long
-                self.status = CALL_STATUS[1] # ABANDONED
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time
-            
-            # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1                 
-    
-    def start_sales_call(self, call_center):
-        arrive = self.env.now
-        
-        with call_center['Sales'].request() as req:
-            results = yield req | self.env.timeout(self.patience)
+        with resource.request() as req:
+            patience = start_patience(self.env, self.patience)
+            results = yield req | patience
             
             # Add in the wait time
             self.t_wait_time += (self.env.now - arrive)
             
             # Determine if we got to the call or if we abandoned
             if req in results:
-                t_call = random.triangular(CALL_TIME_SALES[0],
-                                           CALL_TIME_SALES[1],
-                                           CALL_TIME_SALES[2])
+                cancel_patience(patience)
+                t_call = random.triangular(call_time[0],
+                                           call_time[1],
+                                           call_time[2])
                 
-                # Have the call with Sales Staff
+                # Have the call with the staff
                 yield self.env.timeout(t_call)
                 self.t_work_time += t_call
+                self.end_call(CALL_STATUS[3])
                 
-                # Call completed
-                self.status = CALL_STATUS[3] # Completed
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time                
-                               
                 # Did we make the sale?
-                if random.random() <= SALE_CLOSE_RATE:
+                if close_rate is not None and random.random() <= close_rate:
                     self.new_sale = 1
-                                    
-                # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1               
-                                
             else:
                 # Customer abandoned the call, waited too long
-                self.status = CALL_STATUS[1] # ABANDONED
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time
-                # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1
-                  
-        
-    def start_status_call(self, call_center):
-        # Step 1, Automated System
-        t_ivr = random.triangular(IVR_ORDER_STATUS_DELAY[0],
-                                  IVR_ORDER_STATUS_DELAY[1],
-                                  IVR_ORDER_STATUS_DELAY[2])
-        
-        # Have the call with IVR
-        yield self.env.timeout(t_ivr)
-        self.t_work_time += t_ivr
-        
-        # Do we need to transfer to a sales person?
-        if random.random() <= ORDER_STATUS_REQUIRE_SALES:
-            # Transfer to sales for order status
-            self.env.process(self.order_status_requires_sales(call_center))
-        else:
-            # Finish call and log complete
-            self.status = CALL_STATUS[3]
-            self.t_stop_time = env.now
-            self.t_total_time = self.t_stop_time - self.t_start_time
-            # Release the trunk line -- probably should somehow link this through better
-            call_center_trunk_lines['Active'] -= 1
-            
-            # Customer completed the call
-    
-    def order_status_requires_sales(self, call_center):
-        arrive = self.env.now
-        
-        with call_center['Sales'].request() as req:
-            results = yield req | self.env.timeout(self.patience)
-            
-            # Add in the wait time
-            self.t_wait_time += (self.env.now - arrive)
-            
-            # Determine if we got to the call or if we abandoned
-            if req in results:
-                t_call = random.triangular(CALL_TIME_ORDER_STATUS[0],
-                                           CALL_TIME_ORDER_STATUS[1],
-                                           CALL_TIME_ORDER_STATUS[2])
-                
-                # Have the call with Sales Staff
-                yield self.env.timeout(t_call)
-                self.t_work_time += t_call
-                
-                # Call completed
-                self.status = CALL_STATUS[3] # Completed
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time
-                                  
-                # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1               
-                                
-            else:
-                # Customer abandoned the call, waited too long
-                self.status = CALL_STATUS[1] # ABANDONED
-                self.t_stop_time = env.now
-                self.t_total_time = self.t_stop_time - self.t_start_time
-                # Release the trunk line
-                call_center_trunk_lines['Active'] -= 1
+                self.end_call(CALL_STATUS[1])
+
+    def end_call(self, status):
+        # Call completed or abandoned, release the trunk line
+        self.status = status
+        self.t_stop_time = self.env.now
+        self.t_total_time = self.t_stop_time - self.t_start_time
+        call_center_trunk_lines.add(-1)
+
+    def getTallies(self):
+        return [self.name, self.call_type, self.call_subtype, self.status, self.new_sale,
+                self.t_start_time, self.t_wait_time, self.t_work_time, self.t_stop_time,
+                self.t_total_time]
           
 ############################################################
 # Functions        
 
+def start_patience(env, patience):
+    """Event that succeeds when a waiting caller runs out of patience
+       A cancelable deadline if PATIENCE_TIMERS, else a plain timeout"""
+    if patience_timers is not None:
+        return patience_timers.start(patience)
+    return env.timeout(patience)
+
+def cancel_patience(patience):
+    """Drops the patience deadline of an answered call"""
+    if patience_timers is not None:
+        patience_timers.cancel(patience)
+
 def customer_source(env, arrival_interval, call_center, trunk_lines):
     """Source generates customers randomly
        env = simpy Environment
@@ -301,25 +233,33 @@ def customer_source(env, arrival_interval, call_center, trunk_lines):
         if env.now < DAILY_END_TIME:
             c_name = 'Customer%000006d' % i
             # Customer Initial Attributes
-            c_call_type = np.random.choice(SEGMENT_NAMES, 1, p=SEGMENT_FRACTION)[0]
-            c_call_subtype = np.random.choice(TECH_NAMES, 1, p=TECH_FRACTION)[0] # Used only by Techs
+            c_call_type = segment_tapes['Segment'].draw()
+            if c_call_type == SEGMENT_NAMES[0]:
+                c_call_subtype = segment_tapes['Tech Segment'].draw() # Used only by Techs
+            else:
+                c_call_subtype = None
             
             c_call_patience = random.triangular(WAIT_TIME_PATIENCE[0],
                                                 WAIT_TIME_PATIENCE[1],
                                                 WAIT_TIME_PATIENCE[2])
            
-            # Is trunk line available?
-            if (trunk_lines['Active'] < trunk_lines['Max']):
-                trunk_lines['Active'] += 1
+            # Is trunk line available? (the monitor counts the blocked calls)
+            if trunk_lines.seize():
                 c_call_status = CALL_STATUS[2] # In Progress
                 
             else:
                 c_call_status = CALL_STATUS[0] # Line Busy
-                          
-            trunk_line_usage.append([env.now, trunk_lines['Active']])
                 
             # Create the customer in the simulation
-            customer_call_list.append(Customer(env, c_name, c_call_type, c_call_subtype, c_call_patience, c_call_status, call_center))
+            customer_call_list.append(Customer(env, c_name, c_call_type, c_call_subtype,
+                                               c_call_patience, c_call_status, call_center))
+
+            # Move finished calls to disk so the list only holds calls in progress
+            if tally_sink is not None:
+                tally_sink.collect(customer_call_list, call_finished)
+
+def call_finished(customer):
+    return customer.status != CALL_STATUS[2]
                 
              
 # Could revoke the data class and add this as a method for run parameters class
@@ -334,7 +274,92 @@ def printRunParameters(run_params):
     print("Time Units: %s" % run_params.time_units)
     print("Author: %s" % run_params.author)
     print("DateTime: %s" % run_params.date_time)
-    print("Print Results: %s" % run_params.print_data)        
+    print("Print Results: %s" % run_params.print_data)
+    print("Workers: %s" % run_params.workers)
+
+def triangular_mean(params):
+    """Mean of random.triangular(params[0], params[1], params[2]) as the model
+       draws it: the arguments are low, high, mode, and a mode outside
+       [low, high] stretches the range instead of being clipped"""
+    low, high, mode = params
+    c = (mode - low) / (high - low)
+    m = min(max(c, 0.0), 1.0)
+    return (m * low + (high - low) * math.sqrt(max(c, 0.0)) * 2 / 3 * m ** 1.5
+            + (1 - m) * high - (high - low) * math.sqrt(max(1 - c, 0.0)) * 2 / 3 * (1 - m) ** 1.5)
+
+def staffing_screen(staffing):
+    """Erlang A / Erlang B approximation of the call center during opening hours
+       staffing = candidates x STAFFING_COLUMNS (trunk lines, then agents per pool),
+                  thousands of candidates are evaluated at once
+       returns a DataFrame with one row per candidate: trunk blocking, abandonment,
+       average wait (ASA, abandons included), service level and utilization per pool
+       Each pool is an M/M/c+M queue with an exponential patience of the same
+       mean as WAIT_TIME_PATIENCE.  The trunk lines are held from the call to its
+       end, so their blocking (Erlang B) and the pools are solved together."""
+    staffing = np.atleast_2d(np.asarray(staffing, dtype=float))
+    arrival_rate = 1.0 / CUSTOMER_RATE
+    patience = triangular_mean(WAIT_TIME_PATIENCE)
+
+    # Walk CALL_ROUTES for the IVR time and the agent pools of an accepted call
+    tech_pools = dict(zip(TECH_NAMES, STAFFING_COLUMNS[2:]))
+    ivr_time = 0.04                             # connect
+    pool_share = {}                             # pool -> fraction of accepted calls
+    pool_talk = {}                              # pool -> share-weighted talk time
+    for segment, fraction in zip(SEGMENT_NAMES, SEGMENT_FRACTION):
+        reach = fraction
+        for stage in CALL_ROUTES[segment]:
+            if stage[0] == 'delay':
+                ivr_time += reach * stage[1]
+            elif stage[0] == 'ivr':
+                ivr_time += reach * triangular_mean(stage[1])
+            elif stage[0] == 'transfer':
+                reach *= stage[1]
+            elif stage[0] == 'agent':
+                if stage[1] is None:
+                    pools = [(tech_pools[name], share)
+                             for name, share in zip(TECH_NAMES, TECH_FRACTION)]
+                else:
+                    pools = [(stage[1], 1.0)]
+                talk = triangular_mean(stage[2])
+                for pool, share in pools:
+                    pool_share[pool] = pool_share.get(pool, 0.0) + reach * share
+                    pool_talk[pool] = pool_talk.get(pool, 0.0) + reach * share * talk
+
+    # Blocking thins the arrivals to the pools, which sets the trunk holding time
+    blocking = np.zeros(len(staffing))
+    for iteration in range(SCREEN_ITERATIONS):
+        accepted = arrival_rate * (1 - blocking)
+        wait_limit = SERVICE_LEVEL_TIME if iteration == SCREEN_ITERATIONS - 1 else None
+        holding = ivr_time
+        pools = {}
+        for pool, share in pool_share.items():
+            talk = pool_talk[pool] / share
+            pools[pool] = erlang_a(staffing[:, STAFFING_COLUMNS.index(pool)], accepted * share,
+                                   talk, patience, wait_limit)
+            served_talk = (1 - pools[pool]['Abandonment']) * talk
+            holding = holding + share * (pools[pool]['Wait'] + served_talk)
+        if iteration < SCREEN_ITERATIONS - 1:
+            blocking = erlang_b(staffing[:, 0], arrival_rate * holding)
+
+    screen = pd.DataFrame(staffing.astype(int), columns=STAFFING_COLUMNS)
+    screen['Cost'] = staffing @ np.array([COST_TRUNK_LINE, COST_STAFF_SALES, COST_STAFF_TECH_A,
+                                          COST_STAFF_TECH_B, COST_STAFF_TECH_C])
+    screen['Blocking Probability'] = blocking
+    screen['Abandoned %'] = 100 * (1 - blocking) * sum(share * pools[pool]['Abandonment']
+                                                       for pool, share in pool_share.items())
+    screen['Lost %'] = 100 * blocking + screen['Abandoned %']
+    for pool in pool_share:
+        screen['Abandonment (%s)' % pool] = pools[pool]['Abandonment']
+        screen['ASA (%s)' % pool] = pools[pool]['Wait']
+        screen['Service Level (%s)' % pool] = pools[pool]['Service Level']
+        screen['Utilization (%s)' % pool] = pools[pool]['Utilization']
+    return screen
+
+def staffing_grid(ranges):
+    """Every combination of the staffing ranges
+       ranges = dict of STAFFING_COLUMNS -> values
+       returns an array of candidates x STAFFING_COLUMNS"""
+    return np.array(list(itertools.product(*[ranges[c] for c in STAFFING_COLUMNS])))
         
 ############################################################
 # Run parameters''
@@ -348,7 +373,8 @@ run_params = RunParameters(problem_name = 'Call Center Model',
                            time_units   = TimeUnits.minutes,
                            author       = "Chris Kennedy",
                            date_time    = datetime.now(),
-                           print_data   = False)
+                           print_data   = False,
+                           workers      = None)
 
 ############################################################
 # Problem Description
@@ -397,6 +423,28 @@ WAIT_TIME_PATIENCE = [0,  2, 13] # Triangular Distribution - source: Talkdesk
 
 SALE_CLOSE_RATE = 0.90                # % of inbound sales calls that succeed
 
+# Call routing: the stages of a call by segment, run in order in one process
+#   ('delay', t)                    IVR for t minutes
+#   ('ivr', [a, b, c])              IVR for a triangular time
+#   ('transfer', p)                 go on to the next stage with probability p,
+#                                   otherwise the call is completed
+#   ('agent', resource, [a, b, c], close_rate)
+#                                   queue for a staff resource (None = by tech
+#                                   segment), abandon after the caller's patience,
+#                                   talk for a triangular time, new sale with
+#                                   probability close_rate (None = no sale)
+# A call is completed after its last stage
+CALL_ROUTES = {
+    SEGMENT_NAMES[0]: [('delay', IVR_DELAY),                       # Tech
+                       ('delay', IVR_DELAY),
+                       ('agent', None, CALL_TIME_TECH, None)],
+    SEGMENT_NAMES[1]: [('delay', IVR_DELAY),                       # Sales
+                       ('agent', 'Sales', CALL_TIME_SALES, SALE_CLOSE_RATE)],
+    SEGMENT_NAMES[2]: [('delay', IVR_DELAY),                       # Order Status
+                       ('ivr', IVR_ORDER_STATUS_DELAY),
+                       ('transfer', ORDER_STATUS_REQUIRE_SALES),
+                       ('agent', 'Sales', CALL_TIME_ORDER_STATUS, None)]}
+
 # reference to costs
 COST_TRUNK_LINE    = 20
 COST_STAFF_TECH_A  = 250
@@ -404,6 +452,25 @@ COST_STAFF_TECH_B  = 250
 COST_STAFF_TECH_C  = 300
 COST_STAFF_SALES   = 200
 
+@dataclass(frozen=True)
+class Staffing:
+    trunk_lines: int = NUM_TRUNK_LINES
+    sales: int = NUM_STAFF_SALES
+    tech_a: int = NUM_STAFF_TECH_A
+    tech_b: int = NUM_STAFF_TECH_B
+    tech_c: int = NUM_STAFF_TECH_C
+
+    def as_list(self):
+        return [self.trunk_lines, self.sales, self.tech_a, self.tech_b, self.tech_c]
+
+    def label(self):
+        return '-'.join(str(x) for x in self.as_list())
+
+    def cost(self):
+        return (COST_TRUNK_LINE * self.trunk_lines + COST_STAFF_SALES * self.sales +
+                COST_STAFF_TECH_A * self.tech_a + COST_STAFF_TECH_B * self.tech_b +
+                COST_STAFF_TECH_C * self.tech_c)
+
 # No new calls after daily end-time.
 DAILY_START_TIME = 0         # 6 AM
 DAILY_END_TIME = 12 * 60     # 6 PM = 12 hours * 60 minutes per hour
@@ -411,89 +478,417 @@ DAILY_END_TIME = 12 * 60     # 6 PM = 12 hours * 60 minutes per hour
 ############################################################
 # Monitoring
 customer_call_list = []
-trunk_line_tally = []
+call_center_trunk_lines = None
+tally_sink = None
+segment_tapes = None    # VariateTapes of the call segments of the running replication
+patience_timers = None  # PatienceTimers of the running replication
+event_counts = None     # (events scheduled, peak event heap) of the last replication (COUNT_EVENTS)
+checkpoint = None       # Checkpoint of the run (CHECKPOINT_DIR)
+
+# Segment and tech sub-type are sampled in blocks from alias tables (constant
+# time per call), the sub-type only for Tech calls
+SEGMENT_STREAMS = ['Segment','Tech Segment']
+
+TALLY_COLUMNS = ['Name','Segment','Tech Segment','Status','New Sale',
+                 'Start Time','Wait Time','Process Time','Stop Time','Total Time']
+# Export types of the columns that are not float64
+TALLY_TYPES = {'Name': 'string', 'Segment': 'string', 'Tech Segment': 'string',
+               'Status': 'string', 'New Sale': 'int64'}
+
+# Write the call tallies to EXPORT_DIR in chunks while the model runs (None = keep in memory)
+EXPORT_DIR = None            # e.g. 'output/call_center'
+EXPORT_CHUNK_ROWS = 65536
+
+# Keep the replication and summary KPIs of every run in a SQLite file (None = off)
+EXPERIMENT_DB = None         # e.g. 'experiments.sqlite'
+CONFIDENCE    = 0.95
+
+# Trunk lines in use are averaged over intervals of this many minutes
+TRUNK_LINE_INTERVAL = 10
+
+# Staff utilization and queue length profiles, minutes per interval (hourly)
+STAFF_INTERVAL = 60
+
+# Cancel the patience deadline of answered calls instead of leaving a timeout
+# on the event heap until it expires (see des_patience).  Off by default: the
+# heap stays smaller, but more events are scheduled and the run is slower
+# here, even with most calls abandoning (PATIENCE_COMPARISON)
+PATIENCE_TIMERS = False
+
+# Count the events scheduled and the peak event heap size of every replication
+COUNT_EVENTS = False
+
+# Run one replication of this staffing with PATIENCE_TIMERS off and on, and
+# print the events scheduled, peak event heap and run time of both (None = off)
+PATIENCE_COMPARISON = None
+# PATIENCE_COMPARISON = Staffing(trunk_lines=200)   # long queues, about half the calls abandon
+
+# Analytic staffing screen (Erlang A per pool, Erlang B for the trunk lines)
+# printed before the run for the current staffing and the SCREEN_GRID, with the
+# cheapest candidates that lose (block or abandon) at most SCREEN_MAX_LOST % of calls
+STAFFING_SCREEN = False
+STAFFING_COLUMNS = ['Trunk Lines','Sales','Tech A','Tech B','Tech C']
+SERVICE_LEVEL_TIME = 0.5        # answered within 30 seconds
+SCREEN_ITERATIONS = 5           # passes between trunk blocking and the pools
+SCREEN_GRID = {'Trunk Lines': range(10, 31, 2),
+               'Sales': range(2, 9),
+               'Tech A': range(2, 9),
+               'Tech B': range(2, 9),
+               'Tech C': range(2, 9)}
+SCREEN_MAX_LOST = 10.0
+SCREEN_SHORTLIST = 10
+
+# Staffing optimization, in place of the normal run - the cheapest staffing
+# (Staffing.cost, from the COST_* constants) whose simulated KPI means meet
+# OPTIMIZE_CONSTRAINTS.  The candidates are the OPTIMIZE_CANDIDATES cheapest of
+# the SCREEN_GRID whose analytic KPIs are within OPTIMIZE_SCREEN_SLACK of the
+# limits; replications go to the close calls (des_optimize).  OPTIMIZE_ALPHA
+# is the error level of the whole search (Bonferroni over the candidates,
+# constraints and the rounds OPTIMIZE_MAX_REPLICATIONS allows)
+OPTIMIZE_STAFFING = False
+OPTIMIZE_CONSTRAINTS = {'Abandoned %': 5.0, 'Blocking Probability': 0.02}
+OPTIMIZE_CANDIDATES = 20
+OPTIMIZE_SCREEN_SLACK = 0.5
+OPTIMIZE_ALPHA = 0.05
+OPTIMIZE_MAX_REPLICATIONS = 40
+
+# Checkpoint - save every replication to CHECKPOINT_DIR as soon as it finishes
+# (None = off).  After a crash, set RESUME = True and run again: the saved
+# replications are read back, the rest are simulated with their own seeds, and
+# the results are the same as those of an uninterrupted run.  RESUME = False
+# clears the checkpoint.  Not used with EXPORT_DIR, a restored replication
+# would not write its export file.
+CHECKPOINT_DIR = None        # e.g. 'checkpoints/call_center'
+RESUME = False
+# Constants that do not change a replication, only what is run or reported
+RESULT_CACHE_IGNORE = ['EXPERIMENT_DB','CONFIDENCE','COUNT_EVENTS','PATIENCE_COMPARISON',
+                       'STAFFING_SCREEN','SERVICE_LEVEL_TIME','SCREEN_ITERATIONS',
+                       'SCREEN_GRID','SCREEN_MAX_LOST','SCREEN_SHORTLIST',
+                       'OPTIMIZE_STAFFING','OPTIMIZE_CONSTRAINTS','OPTIMIZE_CANDIDATES',
+                       'OPTIMIZE_SCREEN_SLACK','OPTIMIZE_ALPHA','OPTIMIZE_MAX_REPLICATIONS']
 
 ############################################################
 # Initialize and Run
 
-# I need both seeds since I'm using the NP Random choice function
-random.seed(run_params.random_seed)
-np.random.seed(run_params.random_seed)
-
-for i in range(run_params.replications):
-    print("Starting replication...%06d" % (i+1))
-    env = simpy.Environment()
-
-    trunk_line_usage = []
-
-    sales   = simpy.Resource(env, capacity = NUM_STAFF_SALES)
-    tech_a  = simpy.Resource(env, capacity = NUM_STAFF_TECH_A)
-    tech_b  = simpy.Resource(env, capacity = NUM_STAFF_TECH_A)
-    tech_c  = simpy.Resource(env, capacity = NUM_STAFF_TECH_A)
+def run_replication(replication, seed, staffing=Staffing()):
+    """Runs one replication of the call center
+       replication = replication index (0 based)
+       seed = seed for this replication only (see des_runner.replication_seed)
+       staffing = trunk lines and staff of the run
+       returns the customer tallies (the export file if EXPORT_DIR is set), the
+       trunk line statistics and the staff utilization statistics of the replication
+       """
+    global customer_call_list, call_center_trunk_lines, tally_sink, segment_tapes, patience_timers
+    global event_counts
+
+    # Segments come from alias-table tapes, everything else from random
+    random.seed(seed)
+    streams = RandomStreams(seed, SEGMENT_STREAMS)
+    segment_tapes = {'Segment': streams.tape('Segment',
+                                             alias_transform(SEGMENT_NAMES, SEGMENT_FRACTION)),
+                     'Tech Segment': streams.tape('Tech Segment',
+                                                  alias_transform(TECH_NAMES, TECH_FRACTION))}
+
+    print("Starting replication...%06d" % (replication+1))
+    env = CountingEnvironment() if COUNT_EVENTS else simpy.Environment()
+    patience_timers = PatienceTimers(env) if PATIENCE_TIMERS else None
+
+    customer_call_list = []
+    if EXPORT_DIR is not None:
+        scenario = run_params.problem_name if staffing == Staffing() else staffing.label()
+        tally_sink = RecordSink(EXPORT_DIR, TALLY_COLUMNS,
+                                {'scenario': scenario, 'replication': replication},
+                                EXPORT_CHUNK_ROWS, types=TALLY_TYPES)
+
+    # Busy staff and queue lengths are recorded only when they change
+    sales   = MonitoredResource(env, capacity = staffing.sales, interval = STAFF_INTERVAL)
+    tech_a  = MonitoredResource(env, capacity = staffing.tech_a, interval = STAFF_INTERVAL)
+    tech_b  = MonitoredResource(env, capacity = staffing.tech_b, interval = STAFF_INTERVAL)
+    tech_c  = MonitoredResource(env, capacity = staffing.tech_c, interval = STAFF_INTERVAL)
       
     call_center_staff = {'Sales': sales, 
                          'Tech A': tech_a,
                          'Tech B': tech_b,
                          'Tech C': tech_c}
     
-    active_trunk_lines = 0
-    call_center_trunk_lines = {'Active': active_trunk_lines,
-                               'Max': NUM_TRUNK_LINES}
+    # Trunk lines in use are recorded only when a line is seized or released
+    call_center_trunk_lines = LevelMonitor(env, staffing.trunk_lines, TRUNK_LINE_INTERVAL)
 
     # Run Sim.py
     env.process(customer_source(env,CUSTOMER_RATE, call_center_staff, call_center_trunk_lines))
     env.run(until=run_params.run_time)
     
-    # Get my utilization data for trunk lines for each replication
-    trunk_line_tally.append([i, trunk_line_usage])
-    
-
-############################################################
-# Collect & Process Results
-finished_list = []
-for i in customer_call_list:
-    if (i.status != CALL_STATUS[2] and i.t_start_time > run_params.warm_up_time):
-        finished_list.append(i)
-
-df = pd.DataFrame(([x.name, x.call_type, x.call_subtype, x.status, x.new_sale,
-                    x.t_start_time, x.t_wait_time, x.t_work_time, x.t_stop_time, 
-                    x.t_total_time] for x in finished_list), 
-                   columns=['Name','Segment','Tech Segment','Status','New Sale',
-                            'Start Time','Wait Time','Process Time','Stop Time',
-                            'Total Time'])
-
-processed_trunk_line_tally = []
-
-for i in trunk_line_tally:
-    for j in i[1]:
-        processed_trunk_line_tally.append([i[0], j[0], j[1]])
+    # Customer objects hold the simpy environment, so only the tallies are returned
+    if tally_sink is not None:
+        tally_sink.write(x.getTallies() for x in customer_call_list)
+        customer_tally, tally_sink = tally_sink.close(), None
+    else:
+        customer_tally = [x.getTallies() + [replication] for x in customer_call_list]
+    staff_tally = {name: resource.results(run_params.run_time)
+                   for name, resource in call_center_staff.items()}
+    if COUNT_EVENTS:
+        event_counts = (env.scheduled, env.peak_queue)
+        print("Replication %06d: %d events scheduled, peak event heap %d"
+              % (replication+1, env.scheduled, env.peak_queue))
+    return customer_tally, call_center_trunk_lines.results(run_params.run_time), staff_tally
+
+def replication_kpis(df, trunk_line_tally, staff_tally):
+    """KPIs of every replication
+       df = tallied calls, trunk_line_tally / staff_tally = run_replication results
+       returns a list of dicts in replication order"""
+    kpis = []
+    for replication, (trunk_lines, staff) in enumerate(zip(trunk_line_tally, staff_tally)):
+        calls = df[df['Replication'] == replication]
+        completed = calls[calls['Status'] == CALL_STATUS[3]]
+        replication_kpis = {'Calls': len(calls),
+                            'Completed %': 100 * (calls['Status'] == CALL_STATUS[3]).mean(),
+                            'Abandoned %': 100 * (calls['Status'] == CALL_STATUS[1]).mean(),
+                            'Blocking Probability': trunk_lines['blocking_probability'],
+                            'Wait Time': completed['Wait Time'].mean(),
+                            'Total Time': completed['Total Time'].mean(),
+                            'Sales': calls['New Sale'].sum(),
+                            'Trunk Lines in Use': trunk_lines['mean']}
+        for name, s in staff.items():
+            replication_kpis['Utilization (%s)' % name] = s['utilization']
+            replication_kpis['Queue Length (%s)' % name] = s['queue']
+        kpis.append(replication_kpis)
+    return kpis
+
+def staffing_kpis(result):
+    """KPIs of a single replication from its run_replication result"""
+    customers, trunk_lines, staff = result
+    if isinstance(customers, str):
+        all_df = read_records(customers, TALLY_COLUMNS)
+    else:
+        all_df = pd.DataFrame(customers, columns=TALLY_COLUMNS + ['Replication'])
+    all_df['Replication'] = 0
+    df = all_df[(all_df['Status'] != CALL_STATUS[2]) &
+                (all_df['Start Time'] > run_params.warm_up_time)]
+    return replication_kpis(df, [trunk_lines], [staff])[0]
+
+def compare_patience_timers(staffing, seed, repeats=3):
+    """Runs one replication with PATIENCE_TIMERS off and on, same seed
+       repeats = runs of each mode, the fastest run time is reported
+       returns a DataFrame with the events scheduled, the peak event heap, the
+       abandoned % and the run time (seconds) of each mode"""
+    global PATIENCE_TIMERS, COUNT_EVENTS
+    saved = PATIENCE_TIMERS, COUNT_EVENTS
+    rows = {}
+    try:
+        for timers in (False, True):
+            PATIENCE_TIMERS, COUNT_EVENTS = timers, True
+            seconds = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                result = run_replication(0, seed, staffing)
+                seconds.append(time.perf_counter() - start)
+            rows['Timers On' if timers else 'Timers Off'] = {
+                'Events Scheduled': event_counts[0],
+                'Peak Event Heap': event_counts[1],
+                'Abandoned %': staffing_kpis(result)['Abandoned %'],
+                'Seconds': min(seconds)}
+    finally:
+        PATIENCE_TIMERS, COUNT_EVENTS = saved
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+def optimize_staffing():
+    """Cheapest staffing whose simulated KPI means meet OPTIMIZE_CONSTRAINTS
+       The candidates are the cheapest of the analytic screen close to the
+       limits, the replications are allocated by des_optimize
+       returns the candidate Staffing list, the chosen index (or None), whether
+       every cheaper candidate was found infeasible and the per candidate table"""
+    screen = staffing_screen(staffing_grid(SCREEN_GRID))
+    near = np.all([screen[kpi] <= limit * (1 + OPTIMIZE_SCREEN_SLACK)
+                   for kpi, limit in OPTIMIZE_CONSTRAINTS.items()], axis=0)
+    shortlist = screen[near].nsmallest(OPTIMIZE_CANDIDATES, 'Cost')
+    candidates = [Staffing(*row) for row in shortlist[STAFFING_COLUMNS].values.tolist()]
+
+    chosen, decided, table = select_cheapest_feasible(
+        run_replication, [(c,) for c in candidates], [c.cost() for c in candidates],
+        staffing_kpis, OPTIMIZE_CONSTRAINTS, run_params.random_seed, OPTIMIZE_ALPHA,
+        max_replications=OPTIMIZE_MAX_REPLICATIONS, workers=run_params.workers,
+        cache=checkpoint)
+    table.insert(0, 'Staffing', [c.label() for c in candidates])
+    return candidates, chosen, decided, table
+
+def save_experiment(kpis):
+    """Writes a run (replication KPIs and their confidence intervals) to EXPERIMENT_DB"""
+    store = ExperimentStore(EXPERIMENT_DB)
+    run_id = store.start_run(run_params.problem_name, run_params, globals())
+    store.add_replications(run_id, run_params.problem_name, kpis)
+    store.add_summary(run_id, run_params.problem_name, kpi_confidence_intervals(kpis, CONFIDENCE))
+    store.close()
+    return run_id
+
+if __name__ == '__main__' and CHECKPOINT_DIR is not None and EXPORT_DIR is None:
+    checkpoint = Checkpoint(CHECKPOINT_DIR, RESUME)
+
+if __name__ == '__main__' and PATIENCE_COMPARISON is not None:
+    comparison = compare_patience_timers(PATIENCE_COMPARISON, run_params.random_seed)
+    print("\nPatience timers off / on, staffing %s (%s):"
+          % (PATIENCE_COMPARISON.label(), ', '.join(STAFFING_COLUMNS)))
+    print(comparison.to_string(float_format='{:.3f}'.format))
+    print("")
+
+if __name__ == '__main__' and STAFFING_SCREEN:
+    current = staffing_screen(Staffing().as_list())
+    print("Analytic staffing screen, current staffing:")
+    print(current.T.to_string(header=False))
+    screen = staffing_screen(staffing_grid(SCREEN_GRID))
+    shortlist = screen[screen['Lost %'] <= SCREEN_MAX_LOST].nsmallest(SCREEN_SHORTLIST, 'Cost')
+    print("\nCheapest of %d candidates losing at most %.1f%% of calls:"
+          % (len(screen), SCREEN_MAX_LOST))
+    print(shortlist[STAFFING_COLUMNS + ['Cost','Blocking Probability','Abandoned %',
+                                        'Lost %']].to_string())
+    print("")
+
+if __name__ == '__main__' and OPTIMIZE_STAFFING:
+    candidates, chosen, decided, table = optimize_staffing()
+    used = table['Replications'].sum()
+
+    print("")
+    print("Staffing optimization complete")
+    print("")
+    printRunParameters(run_params)
+    print("")
+    print("Candidates:           %6d" % len(candidates))
+    print("Replications:         %6d (equal allocation at the same depth: %d)"
+          % (used, len(table) * table['Replications'].max()))
+    print("")
+    with pd.option_context('display.width', 200):
+        print(table.to_string(float_format='{:.3f}'.format))
+    print("")
+    if chosen is None:
+        print("No candidate was found feasible, widen SCREEN_GRID or OPTIMIZE_SCREEN_SLACK")
+    else:
+        print("Chosen staffing (%s): %s, cost %.0f"
+              % (', '.join(STAFFING_COLUMNS), candidates[chosen].label(),
+                 candidates[chosen].cost()))
+        if decided:
+            print("Every cheaper candidate tested infeasible, the choice holds at level %.2f"
+                  % OPTIMIZE_ALPHA)
+        else:
+            print("Cheaper candidates are still undecided (OPTIMIZE_MAX_REPLICATIONS reached)")
+    print("\nProgram Complete - END")
+
+elif __name__ == '__main__':
+    # Replications are run in parallel (run_params.workers) and merged back in 
+    # replication order, so the results are the same for any number of workers
+    results = run_replications(run_replication, run_params.replications,
+                               run_params.random_seed, run_params.workers,
+                               cache=checkpoint)
+
+    customer_tally = []
+    trunk_line_tally = []
+    staff_tally = []
+    for replication_customers, replication_trunk_lines, replication_staff in results:
+        if EXPORT_DIR is None:
+            customer_tally.extend(replication_customers)
+        trunk_line_tally.append(replication_trunk_lines)
+        staff_tally.append(replication_staff)
+
+    ############################################################
+    # Collect & Process Results
+    if EXPORT_DIR is not None:
+        all_df = read_records(EXPORT_DIR, scenario=run_params.problem_name,
+                              replication=list(range(run_params.replications)))
+        all_df = all_df.rename(columns={'replication': 'Replication'})
+        all_df = all_df[TALLY_COLUMNS + ['Replication']]
+    else:
+        all_df = pd.DataFrame(customer_tally, columns=TALLY_COLUMNS + ['Replication'])
     
-trunk_df = pd.DataFrame(processed_trunk_line_tally,columns=['Replication','Time','Active'])
-trunk_df['Time Group'] = trunk_df.apply(lambda x: math.floor(x['Time'] / 10)*10 + 10, axis=1)
+    df = all_df[(all_df['Status'] != CALL_STATUS[2]) & 
+                (all_df['Start Time'] > run_params.warm_up_time)]
+
+    # Time-weighted average lines in use per interval, labelled by interval end
+    interval_means = [t['interval_means'] for t in trunk_line_tally]
+    trunk_df = pd.DataFrame({
+        'Replication': np.repeat(np.arange(len(interval_means)), [len(m) for m in interval_means]),
+        'Time Group': np.concatenate([(np.arange(len(m)) + 1) * TRUNK_LINE_INTERVAL
+                                      for m in interval_means]),
+        'Active': np.concatenate(interval_means)})
+
+    blocking_df = pd.DataFrame({'Calls': [t['arrivals'] for t in trunk_line_tally],
+                                'Line Busy': [t['blocked'] for t in trunk_line_tally],
+                                'Blocking Probability': [t['blocking_probability']
+                                                         for t in trunk_line_tally],
+                                'Time All Lines Busy': [t['time_at_capacity']
+                                                        for t in trunk_line_tally],
+                                'Average Lines in Use': [t['mean'] for t in trunk_line_tally]})
+    blocking_df.index.name = 'Replication'
+
+    # Fraction of time with 0 .. NUM_TRUNK_LINES lines in use
+    trunk_histogram = np.mean([t['histogram'] for t in trunk_line_tally], axis=0)
+
+    # Staff utilization and average queue length per replication and resource
+    staff_df = pd.DataFrame([[i, name, s['utilization'], s['busy'], s['queue'],
+                              s['time_with_queue']]
+                             for i, replication_staff in enumerate(staff_tally)
+                             for name, s in replication_staff.items()],
+                            columns=['Replication','Resource','Utilization','Busy Staff',
+                                     'Queue Length','Time with Queue'])
+
+    # Hourly profiles averaged across replications, one column per resource
+    staff_names = list(staff_tally[0])
+    hours = np.arange(len(staff_tally[0][staff_names[0]]['utilization_profile']))
+    utilization_profile = pd.DataFrame(
+        {name: np.mean([r[name]['utilization_profile'] for r in staff_tally], axis=0)
+         for name in staff_names}, index=pd.Index(hours, name='Hour'))
+    queue_profile = pd.DataFrame(
+        {name: np.mean([r[name]['queue_profile'] for r in staff_tally], axis=0)
+         for name in staff_names}, index=pd.Index(hours, name='Hour'))
     
-############################################################
-# Display Results
-print("")
-print("Simulation complete")
-print("")
-printRunParameters(run_params)   
-print("")
-print("Customers:            %6d" % len(customer_call_list))
-print("Tallied Customers:    %6d" % len(finished_list))
-print("")
-print("\nData Counts for Tallies across all replications:")
-print("Completed Sales: ", df['New Sale'].sum())
-print(df[['Name','Status']].groupby(by=['Status']).count())
-print("\nCounts by Call Type and Status - focus on LINE BUSY:")
-print(df[['Segment','Status','Name']].groupby(by=['Segment','Status']).count())
-print("\nAverages by Call Type and Status")
-print(df[['Segment','Total Time','Status','Wait Time']].groupby(by=['Status','Segment']).mean())
-############################################################
-# Plot Trunk Line usage
-plt.plot(trunk_df[trunk_df['Replication']==0]['Time'], trunk_df[trunk_df['Replication']==0]['Active'])
-plt.hist(trunk_df['Active'], bins=19, density=True)
-
-
-############################################################
-# Finished
-print("\nProgram Complete - END")
+    if EXPERIMENT_DB is not None:
+        save_experiment(replication_kpis(df, trunk_line_tally, staff_tally))
+
+    ############################################################
+    # Display Results
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)   
+    print("")
+    print("Customers:            %6d" % len(all_df))
+    print("Tallied Customers:    %6d" % len(df))
+    print("")
+    print("\nData Counts for Tallies across all replications:")
+    print("Completed Sales: ", df['New Sale'].sum())
+    print(df[['Name','Status']].groupby(by=['Status']).count())
+    print("\nCounts by Call Type and Status - focus on LINE BUSY:")
+    print(df[['Segment','Status','Name']].groupby(by=['Segment','Status']).count())
+    print("\nAverages by Call Type and Status")
+    print(df[['Segment','Total Time','Status','Wait Time']].groupby(by=['Status','Segment']).mean())
+    print("\nTrunk Lines by Replication (time-weighted):")
+    print(blocking_df.to_string())
+    print("\nBlocking Probability: %.4f" % blocking_df['Blocking Probability'].mean())
+    if STAFFING_SCREEN:
+        print("Analytic (Erlang B):  %.4f" % current['Blocking Probability'].iloc[0])
+        print("Abandoned %%:          %.2f (analytic %.2f)"
+              % (100 * (df['Status'] == CALL_STATUS[1]).mean(), current['Abandoned %'].iloc[0]))
+    print("\nStaff Utilization and Queue Length (time-weighted, all replications):")
+    print(staff_df.drop(columns='Replication').groupby('Resource', sort=False).mean())
+    print("\nHourly Utilization:")
+    print(utilization_profile.round(3).to_string())
+    print("\nHourly Average Queue Length:")
+    print(queue_profile.round(3).to_string())
+    ############################################################
+    # Plot Trunk Line usage
+    first_df = trunk_df[trunk_df['Replication']==0]
+    plt.step(first_df['Time Group'], first_df['Active'])
+    plt.xlabel('Time (minutes)')
+    plt.ylabel('Average Trunk Lines in Use')
+    plt.figure()
+    plt.bar(np.arange(NUM_TRUNK_LINES + 1), trunk_histogram)
+    plt.xlabel('Trunk Lines in Use')
+    plt.ylabel('Fraction of Time')
+
+    ############################################################
+    # Plot Staff utilization
+    plt.figure()
+    utilization_profile.plot(ax=plt.gca(), drawstyle='steps-post')
+    plt.ylabel('Utilization')
+
+
+    ############################################################
+    # Finished
+    print("\nProgram Complete - END")
@@ -3,7 +3,6 @@
 Created on Sat Jun 27 17:14:14 2020
 
 @author: Chris Kennedy
-TODO: Fix tally class
 
 """
 
@@ -19,11 +18,19 @@ TODO: Fix tally class
 # Libraries
 
 import simpy
-import random
 import pandas as pd
 from dataclasses import dataclass
 from enum import Enum
 from datetime import datetime
+from des_runner import run_replications, run_antithetic_pairs, replication_seed
+from des_stats import antithetic_summary, BatchMeansTally, StreamingTally, combine_streaming_tallies
+from des_random import RandomStreams, exponential_transform, normal_transform, save_tapes, load_tapes
+from des_tally import Tally
+from des_sink import RecordSink, read_records
+from des_lanes import Lane, LaneSelector
+from des_cache import ResultCache
+from des_queueing import (censored_normal_moments, lane_approximation, compare_with_simulation,
+                          SHORTEST_QUEUE_POLICIES)
 
 #####################################################
 # Classes
@@ -49,124 +56,69 @@ class RunParameters:
     author: str = "author"
     date_time: datetime = datetime.now()
     print_data: bool = False
-
-# TODO
-# I need to figure out how to make these more like a data structure (attributes not vars)
-# @dataclass
-# class Tally:
-#    start_time: float
-#   stop_time: float
-#    wait_time: float
-#    process_time: float
-#    total_time: float
+    workers: int = 1            # processes for replications, None = all cores
 
 class Customer(object):
-    def __init__(self, env, name, cashier_list, select_method):
+    def __init__(self, env, c_id, lane_selector):
         self.env = env
-        self.name = name
-        self.select_method = select_method
-        # self.tally = Tally
-        # self.tally.start_time = env.now
+        self.id = c_id
         self.t_start_time = env.now
-        self.active = 1
-        self.co_time = 0
+        # Drawn on arrival so customer i gets the i-th checkout draw in every run
+        self.co_time = self.checkout_time()
         # Start the run process everytime an instance is created
-        self.action = env.process(self.checkout(cashier_list, select_method))
+        self.action = env.process(self.checkout(lane_selector))
 
             
     def checkout_time(self):
-        # bounded random normal (negative times not allowed)
+        # bounded random normal (negative times not allowed), see CHECKOUT_MU
         # Checkout time really should be a combination of goods from
         # customer as well as speed of cashier
         # so storing this all in the Customer class is not ideal
-        MU = 1.0
-        SIGMA = 0.5
-        rn = random.normalvariate(MU, SIGMA)
-        result = rn if rn >= 0.0000001 else 0.0000001
-        return result
+        return tapes['Checkout'].draw()
     
-    def pick_cashier_greedy(self, cashier_list):
-        # Picks the cashier with the shortest queue (by count)
-        cashier = cashier_list[0]
-        queue_len = len(cashier.queue)
-        
-        for checkout in cashier_list:
-            if len(checkout.queue) < queue_len:
-                cashier = checkout
-                queue_len = len(checkout.queue)
-        
-        return cashier
-            
-    def pick_cashier_random(self, cashier_list):
-        # Picks cashier at random
-        cashier = random.choice(cashier_list)
-        return cashier
-        
-    def pick_cashier_lazy(self, cashier_list):
-        # Looks at two lines at random and picks the shortest one
-        if len(cashier_list) == 1:
-            return cashier_list[0]
-        
-        # Pick two at random
-        tmp_list = list(range(len(cashier_list)))
-        random.shuffle(tmp_list)
-        cashier_result = cashier_list[tmp_list[0]] if len(cashier_list[tmp_list[0]].queue) < len(cashier_list[tmp_list[1]].queue) else cashier_list[tmp_list[1]]
-        return cashier_result
-
-    def pick_cashier(self, cashier_list, select_method):
-        if select_method == 'greedy':
-            return self.pick_cashier_greedy(cashier_list)
-        elif select_method == 'random':
-            return self.pick_cashier_random(cashier_list)
-        elif select_method == 'lazy':
-            return self.pick_cashier_lazy(cashier_list)
-        else:
-            return cashier_list[0]
-
-    def checkout(self, cashier_list, select_method):
-        # Pick a checkout line
-        cashier = self.pick_cashier(cashier_list, select_method)
+    def checkout(self, lane_selector):
+        # Pick a checkout line (LANE_POLICY)
+        cashier = lane_selector.pick()
         with cashier.request() as req:
             yield req
             
             start_checkout = self.env.now
-            self.co_time = self.checkout_time()
             yield self.env.timeout(self.co_time)
            
-            # Record tallies
-            # TODO I removed this because the tally data class was operating
-            # TODO as a shared class variable as opposed to attributes for each class
-            # TODO Will need to fix and make more appropriate data structure
-            # self.tally.wait_time = start_checkout - self.tally.start_time
-            # self.tally.process_time = self.co_time
-            # self.tally.stop_time = self.env.now
-            # self.tally.total_time = self.tally.stop_time - self.tally.start_time
-            
-            self.t_wait_time = start_checkout - self.t_start_time
-            self.t_process_time = self.co_time
-            self.t_stop_time = self.env.now
-            self.t_total_time = self.t_stop_time - self.t_start_time
-            self.active = 0
-            
-    def getTallies(self):
-        return [self.name, self.t_start_time, self.t_wait_time, self.t_process_time, self.t_stop_time, self.t_total_time, self.active]
+            # Record tallies on completion, the customer is not kept afterwards
+            t_stop_time = self.env.now
+            t_wait_time = start_checkout - self.t_start_time
+            t_total_time = t_stop_time - self.t_start_time
+
+            if steady_state_tally is not None:
+                steady_state_tally.record(self.t_start_time, [t_wait_time,
+                                                              self.co_time,
+                                                              t_total_time])
+            elif streaming_tally is not None:
+                streaming_tally.record(t_wait_time, self.co_time, t_total_time)
+            elif tally_sink is not None:
+                tally_sink.write([(self.id, self.t_start_time, t_wait_time,
+                                   self.co_time, t_stop_time, t_total_time)])
+            else:
+                customer_tally.record(self.id, self.t_start_time, t_wait_time,
+                                      self.co_time, t_stop_time, t_total_time)
             
 ############################################################
 # Functions        
 
-def customer_source(env, arrival_interval, cashier_list):
+def customer_source(env, arrivals, lane_selector):
     """Source generates customers randomly
        env = simpy Environment
-       interval = arrival lambda for exponential distribution
-       checkout = resource required"""
+       arrivals = VariateTape of the (exponential) interarrival times
+       lane_selector = LaneSelector of the checkout lanes"""
+    global customer_count
     i = 0
     while True:
         i+= 1
-        t = random.expovariate(1.0 / arrival_interval)
+        t = arrivals.draw()
         yield env.timeout(t)
-        c_name = 'Customer%000006d' % i
-        customer_list.append(Customer(env, c_name, cashier_list, 'random'))
-        # method choices = 'random' 'lazy' 'greedy' 'first'
+        customer_count = i
+        Customer(env, i, lane_selector)
                     
 # Could revoke the data class and add this as a method for run parameters class
 def printRunParameters(run_params):
@@ -180,73 +132,294 @@ def printRunParameters(run_params):
     print("Time Units: %s" % run_params.time_units)
     print("Author: %s" % run_params.author)
     print("DateTime: %s" % run_params.date_time)
-    print("Print Reults: %s" % run_params.print_data)        
+    print("Print Reults: %s" % run_params.print_data)
+    print("Workers: %s" % run_params.workers)
         
 ############################################################
 # Run parameters''
 
 run_params = RunParameters(problem_name = 'Grocery 4x4',
                            random_seed  = 52,
-                           replications = 1,  # Replications and warm-up time not supported in this version
+                           replications = 1,   # Set ANTITHETIC for pairs
                            run_time     = 24 * 60 * 10,
-                           warm_up_time = 0,  # Replications and warm-up time not supported in this version
+                           warm_up_time = 0,   # STEADY_STATE only, 0 = detect with MSER-5
                            time_units   = TimeUnits.minutes,
                            author       = "Chris Kennedy",
                            date_time    = datetime.now(),
-                           print_data   = False)
+                           print_data   = False,
+                           workers      = None)
 
 ############################################################
 # Problem-specific parameters
 NUM_CASHIERS  = 4
+CASHIERS_PER_LANE = 1   # cashiers serving the queue of each lane
 CUSTOMER_RATE = 0.33333
 
+# Lane choice - 'random' 'lazy' (shortest of LANE_CHOICES random lanes) 'greedy'
+# (shortest queue) 'round_robin' 'idle' (an idle lane if any) 'first'
+LANE_POLICY  = 'random'
+LANE_CHOICES = 2
+
+# Checkout time - normal, raised to CHECKOUT_MIN (negative times not allowed)
+CHECKOUT_MU    = 1.0
+CHECKOUT_SIGMA = 0.5
+CHECKOUT_MIN   = 0.0000001
+
+# Variate tapes - interarrival and checkout times are generated TAPE_BLOCK at
+# a time.  TAPE_SAVE writes the variates each replication used and TAPE_REPLAY
+# feeds saved ones back, e.g. to run another lane configuration on the
+# identical customers.  '%d' in the file name is replaced by the replication.
+TAPE_BLOCK  = 4096
+TAPE_SAVE   = None      # e.g. 'tapes/grocery_%d.npz'
+TAPE_REPLAY = None
+
+# Variance reduction - run the replications in antithetic pairs, the second
+# run of a pair uses the complementary uniforms 1-U for every draw of the first
+# run.  run_params.replications is rounded up to an even number (at least 20,
+# fewer pairs give no usable correlation or VRF).
+ANTITHETIC = False
+
+# Steady state - one long run instead of replications.  The warm-up is found
+# with MSER-5 (or given by run_params.warm_up_time) and the confidence 
+# intervals come from non-overlapping batch means.  Customers are recorded
+# into batch averages as they finish and are never stored.
+STEADY_STATE = False
+STEADY_STATE_RUN_TIME = 24 * 60 * 30
+STEADY_STATE_KPIS = ['Wait Time','Process Time','Total Time']
+BATCH_COUNT = 20
+
+# Streaming statistics - keep running mean, variance, min/max and t-digest
+# style quantiles (QuantileDigest) per replication in place of the customer
+# table (constant memory, the customer table is not created)
+STREAMING_STATS = False
+STREAMING_KPIS = ['Wait Time','Process Time','Total Time']
+
+# Write the finished customers to EXPORT_DIR in chunks while the model runs
+# (None = keep in memory), one partition per replication.  Not used with
+# STREAMING_STATS or STEADY_STATE, which keep no customer rows.
+EXPORT_DIR = None            # e.g. 'output/grocery'
+EXPORT_CHUNK_ROWS = 65536
+
+# Analytic check - steady-state approximation of the lanes (des_queueing),
+# printed before the run, with a warning if the lanes are unstable (utilization
+# of 1 or more), and compared with the simulated means afterwards.  The run
+# starts empty, so the replications are only close to it for long run times.
+ANALYTIC_CHECK = False
+ANALYTIC_KPIS = {'Wait Time': 'Wq', 'Process Time': 'Service Time', 'Total Time': 'W'}
+
+# Read replications already simulated with the same model, constants and seed
+# from RESULT_CACHE_DIR instead of running them again (None = off).  Not used
+# with variate tapes or EXPORT_DIR (those files are not part of the result)
+# or STEADY_STATE.
+RESULT_CACHE_DIR = None      # e.g. 'cache/grocery'
+RESULT_CACHE_BYTES = 2**30   # least recently used results are evicted beyond this size
+# Constants that do not change a replication, only what is run or reported
+RESULT_CACHE_IGNORE = ['ANTITHETIC','ANALYTIC_CHECK','ANALYTIC_KPIS']
+
 ############################################################
 # Monitoring
-customer_list = []
+customer_tally = None   # Tally of the finished customers of the running replication
+customer_count = 0      # customers created in the running replication
+streams = None          # RandomStreams of the running replication
+tapes = None            # VariateTapes of the running replication ('Arrivals', 'Checkout')
+steady_state_tally = None   # BatchMeansTally of the STEADY_STATE run
+result_cache = None         # ResultCache of the run (RESULT_CACHE_DIR)
+streaming_tally = None      # StreamingTally of the running replication (STREAMING_STATS)
+tally_sink = None           # RecordSink of the running replication (EXPORT_DIR)
+
+# One stream per random source, so the pairs of an antithetic run stay in step
+STREAM_NAMES = ['Arrivals','Checkout','Lane']
+
+TALLY_COLUMNS = ['Start Time','Wait Time','Process Time','Stop Time','Total Time']
+EXPORT_COLUMNS = ['Customer'] + TALLY_COLUMNS
+EXPORT_TYPES = {'Customer': 'int64'}
+KPI_COLUMNS = ['Wait Time','Total Time']
 
 ############################################################
 # Initialize and Run
 
-random.seed(run_params.random_seed)
-env = simpy.Environment()
+def run_replication(replication, seed, antithetic=False, run_time=None):
+    """Runs one replication of the store
+       replication = replication index (0 based)
+       seed = seed for this replication only (see des_runner.replication_seed)
+       antithetic = use the complementary uniforms of the seed
+       run_time = length of the run, run_params.run_time by default
+       returns the finished customers (DataFrame indexed by customer number,
+       the export file with EXPORT_DIR, or a StreamingTally with STREAMING_STATS)
+       and the number of customers created"""
+    global customer_tally, customer_count, streams, tapes, streaming_tally, tally_sink
 
-cashier_list = []
-for i in range(NUM_CASHIERS):
-    cashier_list.append(simpy.Resource(env, capacity=1))
+    # Every draw comes from these streams so a run can be mirrored exactly
+    streams = RandomStreams(seed, STREAM_NAMES, antithetic)
+    if TAPE_REPLAY is not None:
+        tapes = load_tapes(TAPE_REPLAY % replication)
+    else:
+        record = TAPE_SAVE is not None
+        tapes = {'Arrivals': streams.tape('Arrivals', exponential_transform(CUSTOMER_RATE),
+                                          TAPE_BLOCK, record),
+                 'Checkout': streams.tape('Checkout', normal_transform(CHECKOUT_MU, CHECKOUT_SIGMA,
+                                                                      CHECKOUT_MIN),
+                                          TAPE_BLOCK, record)}
 
-############################################################
-# Run Sim.py
+    print("Starting replication...%06d" % (replication+1))
+    env = simpy.Environment()
+    customer_count = 0
+    tally_sink = None
+    if STREAMING_STATS:
+        customer_tally = None
+        streaming_tally = StreamingTally(STREAMING_KPIS)
+    elif EXPORT_DIR is not None and steady_state_tally is None:
+        customer_tally = None
+        tally_sink = RecordSink(EXPORT_DIR, EXPORT_COLUMNS,
+                                {'scenario': run_params.problem_name, 'replication': replication},
+                                EXPORT_CHUNK_ROWS, types=EXPORT_TYPES)
+    else:
+        customer_tally = Tally(TALLY_COLUMNS, index_name='Customer')
+
+    cashier_list = []
+    for i in range(NUM_CASHIERS):
+        cashier_list.append(Lane(env, capacity=CASHIERS_PER_LANE, index=i))
+    lane_selector = LaneSelector(cashier_list, LANE_POLICY, streams['Lane'], LANE_CHOICES)
+
+    ############################################################
+    # Run Sim.py
     
-env.process(customer_source(env,CUSTOMER_RATE, cashier_list))
-env.run(until=run_params.run_time)
+    env.process(customer_source(env, tapes['Arrivals'], lane_selector))
+    env.run(until=run_time or run_params.run_time)
 
-############################################################
-# Collect Results
-finished_list = []
-for i in customer_list:
-    if i.active == 0:
-        finished_list.append(i)
-
-df = pd.DataFrame(([x.name, x.t_start_time, x.t_wait_time, 
-                         x.t_process_time, x.t_stop_time, 
-                         x.t_total_time, x.active] for x in finished_list), 
-                        columns=['Name','Start Time','Wait Time',
-                                 'Process Time','Stop Time','Total Time',
-                                 'Unfinished (WIP)'])
+    if TAPE_SAVE is not None:
+        save_tapes(TAPE_SAVE % replication, tapes)
 
-############################################################
-# printresults
-print("")
-print("Simulation complete")
-print("")
-printRunParameters(run_params)   
-print("")
-print("Customers:            %6d" % len(customer_list))
-print("Completed Customers:  %6d" % len(finished_list))
-print("")
-print("Means for Data Tallies:")
-print(df.mean())
+    if STREAMING_STATS:
+        return streaming_tally, customer_count
+    if tally_sink is not None:
+        return tally_sink.close(), customer_count
+    return customer_tally.to_dataframe(), customer_count
 
-############################################################
-# Finished
-print("\nProgram Complete - END")
+def finished_customers(finished):
+    """Finished customers of one replication, DataFrame indexed by customer
+       number (read back from the export file with EXPORT_DIR)"""
+    if isinstance(finished, str):
+        return read_records(finished, EXPORT_COLUMNS).set_index('Customer')
+    return finished
+
+def replication_kpis(result):
+    """Means of the KPI_COLUMNS for one replication"""
+    finished, _ = result
+    if STREAMING_STATS:
+        means = finished.mean()
+        return {kpi: means[kpi] for kpi in KPI_COLUMNS}
+    return finished_customers(finished)[KPI_COLUMNS].mean().to_dict()
+
+def analytic_results():
+    """Steady-state approximation of the checkout lanes (see des_queueing)"""
+    service_mean, service_scv = censored_normal_moments(CHECKOUT_MU, CHECKOUT_SIGMA, CHECKOUT_MIN)
+    analytic = lane_approximation(CUSTOMER_RATE, NUM_CASHIERS, CASHIERS_PER_LANE,
+                                  service_mean, service_scv, LANE_POLICY)
+    analytic['Service Time'] = service_mean
+    return analytic
+
+def print_analytic_check(analytic, simulated_means):
+    print("")
+    print("Analytic Check (steady state, %s lanes):" % LANE_POLICY)
+    print(compare_with_simulation(analytic, simulated_means, ANALYTIC_KPIS).to_string())
+    if LANE_POLICY in SHORTEST_QUEUE_POLICIES:
+        print("%s lanes fall between independent lanes (above) and one pooled queue:" % LANE_POLICY)
+        print("pooled wait %.3f, total time %.3f" % (analytic['Wq Pooled'], analytic['W Pooled']))
+
+def run_steady_state(seed):
+    """One long run of STEADY_STATE_RUN_TIME recorded into a BatchMeansTally"""
+    global steady_state_tally
+    steady_state_tally = BatchMeansTally(STEADY_STATE_KPIS, 5, run_params.warm_up_time)
+    run_replication(0, seed, run_time=STEADY_STATE_RUN_TIME)
+    return steady_state_tally
+
+if __name__ == '__main__' and ANALYTIC_CHECK:
+    # Screen the configuration before simulating it
+    analytic = analytic_results()
+    print("Analytic utilization %.3f, wait %.3f, total time %.3f"
+          % (analytic['Utilization'], analytic['Wq'], analytic['W']))
+    if not analytic['Stable']:
+        print("WARNING: utilization >= 1, the queues grow without bound (no steady state)")
+
+if __name__ == '__main__' and STEADY_STATE:
+    tally = run_steady_state(replication_seed(run_params.random_seed, 0))
+    steady_state_results, warm_up = tally.results(BATCH_COUNT)
+
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)
+    print("Steady State Run Time: %d" % STEADY_STATE_RUN_TIME)
+    print("")
+    print("Warm-up discarded on record:   %8d customers" % warm_up['Discarded on record'])
+    print("Warm-up truncated by MSER-5:   %8d customers" % warm_up['Truncated by MSER'])
+    print("Warm-up ends at:               %8.1f" % warm_up['Warm-up ends'])
+    print("Customers in batch means:      %8d" % warm_up['Observations used'])
+    print("")
+    print("95%% Confidence Intervals from %d Batch Means:" % warm_up['Batches'])
+    print(steady_state_results.to_string())
+    if ANALYTIC_CHECK:
+        print_analytic_check(analytic, steady_state_results['Mean'])
+    print("\nProgram Complete - END")
+
+elif __name__ == '__main__':
+    if (RESULT_CACHE_DIR is not None and TAPE_SAVE is None and TAPE_REPLAY is None
+            and EXPORT_DIR is None):
+        result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+    antithetic_results = None
+    if ANTITHETIC:
+        pairs = max((run_params.replications + 1) // 2, 10)
+        primary, antithetic = run_antithetic_pairs(run_replication, pairs,
+                                                   run_params.random_seed,
+                                                   run_params.workers, cache=result_cache)
+        results = [r for pair in zip(primary, antithetic) for r in pair]
+        antithetic_results = antithetic_summary([replication_kpis(r) for r in primary],
+                                                [replication_kpis(r) for r in antithetic])
+    else:
+        results = run_replications(run_replication, run_params.replications,
+                                   run_params.random_seed, run_params.workers,
+                                   cache=result_cache)
+
+    ############################################################
+    # Collect Results
+    customers = sum(count for _, count in results)
+    if STREAMING_STATS:
+        streaming_results = combine_streaming_tallies([tally for tally, _ in results])
+        completed = streaming_results['Count'].iloc[0]
+    else:
+        df = pd.concat([finished_customers(finished) for finished, _ in results], 
+                       keys=range(len(results)), names=['Replication','Customer'])
+        completed = len(df)
+
+    ############################################################
+    # printresults
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)   
+    print("")
+    print("Replications run:     %6d" % len(results))
+    print("Customers:            %6d" % customers)
+    print("Completed Customers:  %6d" % completed)
+    print("")
+    if STREAMING_STATS:
+        print("Streaming Statistics for Data Tallies:")
+        print(streaming_results.to_string())
+        simulated_means = streaming_results['Mean']
+    else:
+        print("Means for Data Tallies:")
+        print(df.mean(numeric_only=True))
+        simulated_means = df.mean(numeric_only=True)
+    if ANALYTIC_CHECK:
+        print_analytic_check(analytic, simulated_means)
+
+    if antithetic_results is not None:
+        print("")
+        print("95% Confidence Intervals from Antithetic Pairs:")
+        print(antithetic_results.to_string())
+        print("VRF = variance reduction factor against independent replications")
+
+    ############################################################
+    # Finished
+    print("\nProgram Complete - END")
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: On-disk cache of replication results
+
+A replication is fully determined by the model source, its problem constants
+and run parameters, the arguments it is run with (scenario, decisions), the
+replication index and the seed.  ResultCache hashes all of these into a key
+and keeps the result of every replication in a file named by the key, so a
+run with the same parameters is read back instead of simulated, and a sweep
+with a few new grid points only simulates the new points.
+
+    directory/<first 2 characters of the key>/<key>.pkl
+
+The model source hash covers the code of the model script and every module
+imported from its directory (des_runner, des_stats, ...).  The UPPER_CASE
+constants and run_params of the model script are keyed by their values, not
+their source lines, so changing one only misses the replications it changes.
+Module constants named RESULT_CACHE*, CHECKPOINT* and RESUME are left out of
+the key, so the cache settings themselves do not invalidate it, and so are the
+constants listed in RESULT_CACHE_IGNORE, the ones that only pick what to run
+or how to report it (SWEEP_GRID, EXPERIMENT_DB).  Results are written
+atomically, and the least recently used ones are evicted once the directory
+grows past max_bytes.
+
+A Checkpoint is a ResultCache for one long run: it is never evicted, and it
+starts empty unless the run is resumed.  A resumed run reads the replications
+the interrupted run finished and simulates the rest with the same seeds, so
+its results are those of an uninterrupted run.  Checkpoint files end in .ckpt
+instead of .pkl, so a checkpoint and a result cache can share a directory
+without clearing or evicting each other's files.
+
+Usage from a model script (des_runner does the lookups):
+
+    result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+    results = run_replications(run_replication, run_params.replications,
+                               run_params.random_seed, run_params.workers,
+                               cache=result_cache)
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import ast
+import dataclasses
+import enum
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+from des_store import code_hash
+
+# RunParameters fields that do not change the result of a replication
+VOLATILE_PARAMETERS = ('date_time', 'workers', 'replications', 'print_data')
+
+# Prefixes of the cache and checkpoint settings, never part of a key
+SETTING_PREFIXES = ('RESULT_CACHE', 'CHECKPOINT', 'RESUME')
+
+#####################################################
+# Classes
+
+class ResultCache(object):
+    """Replication results on disk, keyed by everything that determines them
+       directory = cache directory, created if missing
+       max_bytes = size limit of the directory, least recently used results
+                   are evicted beyond it (None = no limit)"""
+    suffix = '.pkl'             # only files with this suffix are read, evicted or cleared
+
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def keys(self, tasks):
+        """Keys of a list of (run_replication, replication, seed, args) tasks"""
+        contexts = {}
+        keys = []
+        for run_replication, replication, seed, args in tasks:
+            if run_replication not in contexts:
+                contexts[run_replication] = scenario_context(run_replication)
+            payload = json.dumps([contexts[run_replication], replication, seed, list(args)],
+                                 sort_keys=True, default=_encode)
+            keys.append(hashlib.sha256(payload.encode('utf-8')).hexdigest())
+        return keys
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.suffix)
+
+    def get(self, key):
+        """(True, result) if the key is cached, otherwise (False, None)"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return False, None
+        except (EOFError, pickle.UnpicklingError):
+            os.remove(path)
+            self.misses += 1
+            return False, None
+        os.utime(path)          # the modification time is the last use
+        self.hits += 1
+        return True, result
+
+    def put(self, key, result):
+        """Stores a result, written to a temporary file and renamed into place"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=self.suffix + '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def evict(self):
+        """Removes the least recently used results until the cache fits max_bytes"""
+        if self.max_bytes is None:
+            return
+        files = []
+        total = 0
+        for folder, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(self.suffix):
+                    stat = os.stat(os.path.join(folder, name))
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(folder, name)))
+                    total += stat.st_size
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """Removes every result stored by this kind of cache (files of other
+           kinds in the same directory are left alone)"""
+        for folder, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith((self.suffix, self.suffix + '.tmp')):
+                    os.remove(os.path.join(folder, name))
+
+class Checkpoint(ResultCache):
+    """Finished replications of a run, each saved as soon as it finishes
+       directory = checkpoint directory, created if missing
+       resume = True keeps the replications saved by an interrupted run so
+                they are not run again, False starts over (removes the .ckpt
+                files only, a result cache in the same directory is kept)"""
+    suffix = '.ckpt'
+
+    def __init__(self, directory, resume=False):
+        super().__init__(directory, max_bytes=None)
+        if not resume:
+            self.clear()
+
+############################################################
+# Functions
+
+def _encode(value):
+    # JSON form of the arguments, constants and parameters that go into a key,
+    # numpy arrays as lists, repr for anything else
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return [type(value).__name__, dataclasses.asdict(value)]
+    if isinstance(value, enum.Enum):
+        return value.value
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return repr(value)
+
+def _constant(value):
+    # Canonical JSON of a module constant, repr if JSON cannot take it
+    try:
+        return json.dumps(value, sort_keys=True, default=_encode)
+    except (TypeError, ValueError):
+        return repr(value)
+
+def _is_keyed_value(target):
+    # Names keyed by their value (scenario_context) rather than their source
+    return isinstance(target, ast.Name) and (target.id.isupper() or target.id == 'run_params')
+
+def model_code_hash(path):
+    """SHA-256 of the code of a model script without its UPPER_CASE constant
+       and run_params assignments (and without comments and docstrings)"""
+    with open(path, 'rb') as f:
+        tree = ast.parse(f.read())
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and all(_is_keyed_value(t) for t in node.targets):
+            continue
+        if isinstance(node, ast.AnnAssign) and _is_keyed_value(node.target):
+            continue
+        body.append(ast.dump(node))
+    return hashlib.sha256('\n'.join(body).encode('utf-8')).hexdigest()
+
+def source_hash(namespace):
+    """SHA-256 over the model script and the modules imported from its directory"""
+    model = namespace.get('__file__')
+    if model is None:
+        return None
+    model = os.path.abspath(model)
+    folder = os.path.dirname(model)
+    paths = set()
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path and path.endswith('.py') and os.path.dirname(os.path.abspath(path)) == folder:
+            paths.add(os.path.abspath(path))
+    paths.discard(model)
+    digest = hashlib.sha256(model_code_hash(model).encode('ascii'))
+    for path in sorted(paths):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        digest.update(code_hash(path).encode('ascii'))
+    return digest.hexdigest()
+
+def scenario_context(run_replication):
+    """Everything in the model module that determines a replication: source
+       hash, problem constants and run parameters"""
+    namespace = run_replication.__globals__
+    ignore = set(namespace.get('RESULT_CACHE_IGNORE', ()))
+    constants = {name: _constant(value) for name, value in namespace.items()
+                 if name.isupper() and not name.startswith(('_',) + SETTING_PREFIXES)
+                 and name not in ignore and not callable(value)}
+    run_params = namespace.get('run_params')
+    parameters = None
+    if dataclasses.is_dataclass(run_params):
+        parameters = {name: value for name, value in dataclasses.asdict(run_params).items()
+                      if name not in VOLATILE_PARAMETERS}
+    return {'function': run_replication.__qualname__,
+            'source': source_hash(namespace),
+            'constants': constants,
+            'run_parameters': parameters}
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Lane selection for the cashier models
+
+Picking a checkout lane by scanning every lane, or by shuffling the list of
+lanes to look at two of them, is fine for 8 lanes but not for hundreds.  A
+LaneSelector picks the policy once at set-up and keeps what the policy needs
+up to date as the lanes change, so a pick costs O(log n) or O(1):
+
+    'greedy'       join the shortest queue, min over an indexed tree of queue
+                   lengths (ties go to the lowest lane)
+    'lazy'         power of d choices, the shortest of d lanes sampled without
+                   replacement (d = 2 by default)
+    'random'       a lane at random
+    'round_robin'  lanes in turn
+    'idle'         join an idle lane at random, any lane at random if none is idle
+    'first'        always the first lane
+
+The lanes must be Lane resources so they can report their changes.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import simpy
+
+#####################################################
+# Classes
+
+class Lane(simpy.Resource):
+    """simpy Resource that reports queue changes to its LaneSelector
+       env = simpy Environment
+       capacity = number of cashiers of the lane
+       index = position of the lane in the list of lanes"""
+    def __init__(self, env, capacity=1, index=0):
+        super().__init__(env, capacity)
+        self.index = index
+        self.selector = None
+
+    def _trigger_put(self, get_event):
+        super()._trigger_put(get_event)
+        if self.selector is not None:
+            self.selector.update(self)
+
+    def _trigger_get(self, put_event):
+        super()._trigger_get(put_event)
+        if self.selector is not None:
+            self.selector.update(self)
+
+class LaneSelector(object):
+    """Picks a lane for every customer with a policy chosen once
+       lanes = list of Lane resources
+       policy = 'greedy', 'lazy', 'random', 'round_robin', 'idle' or 'first'
+       stream = UniformStream for the random choices (one uniform per lane
+                sampled, so antithetic runs stay in step)
+       d = lanes sampled by 'lazy'
+       selector.pick() returns the lane"""
+    def __init__(self, lanes, policy, stream=None, d=2):
+        self.lanes = lanes
+        self.n = len(lanes)
+        self.stream = stream
+        self.d = min(d, self.n)
+        self.next_lane = 0
+        self.update = self._ignore
+
+        if policy == 'greedy':
+            # Segment tree of (queue length, lane index), tree[1] is the minimum
+            self.size = 1
+            while self.size < self.n:
+                self.size *= 2
+            self.tree = [(float('inf'), i) for i in range(2 * self.size)]
+            self.lengths = [0] * self.n
+            for lane in lanes:
+                self.tree[self.size + lane.index] = (len(lane.queue), lane.index)
+            for i in reversed(range(1, self.size)):
+                self.tree[i] = min(self.tree[2 * i], self.tree[2 * i + 1])
+            self.update = self._update_greedy
+            self.pick = self._pick_greedy
+        elif policy == 'lazy':
+            self.pick = self._pick_lazy if self.n > 1 else self._pick_first
+        elif policy == 'random':
+            self.pick = self._pick_random
+        elif policy == 'round_robin':
+            self.pick = self._pick_round_robin
+        elif policy == 'idle':
+            # Idle lanes in a list with their positions, O(1) add / remove / sample
+            self.idle = []
+            self.idle_position = {}
+            for lane in lanes:
+                self._update_idle(lane)
+            self.update = self._update_idle
+            self.pick = self._pick_idle
+        elif policy == 'first':
+            self.pick = self._pick_first
+        else:
+            raise ValueError("Unknown lane policy: %s" % policy)
+
+        for lane in lanes:
+            lane.selector = self if self.update is not self._ignore else None
+
+    def _ignore(self, lane):
+        pass
+
+    def _update_greedy(self, lane):
+        length = len(lane.queue)
+        if length == self.lengths[lane.index]:
+            return
+        self.lengths[lane.index] = length
+        tree = self.tree
+        i = self.size + lane.index
+        tree[i] = (length, lane.index)
+        i //= 2
+        while i:
+            left, right = tree[2 * i], tree[2 * i + 1]
+            smallest = left if left <= right else right
+            if tree[i] == smallest:
+                break       # nothing changes further up
+            tree[i] = smallest
+            i //= 2
+
+    def _pick_greedy(self):
+        return self.lanes[self.tree[1][1]]
+
+    def _pick_lazy(self):
+        # Partial Fisher-Yates over a dict of moved positions: d uniforms, O(d)
+        moved = {}
+        best = None
+        for k in range(self.d):
+            j = k + min(int(self.stream.random() * (self.n - k)), self.n - k - 1)
+            lane = self.lanes[moved.get(j, j)]
+            moved[j] = moved.get(k, k)
+            if best is None or len(lane.queue) <= len(best.queue):
+                best = lane
+        return best
+
+    def _pick_random(self):
+        return self.stream.choice(self.lanes)
+
+    def _pick_round_robin(self):
+        lane = self.lanes[self.next_lane]
+        self.next_lane = (self.next_lane + 1) % self.n
+        return lane
+
+    def _update_idle(self, lane):
+        is_idle = lane.count == 0 and not lane.queue
+        position = self.idle_position.get(lane.index)
+        if is_idle and position is None:
+            self.idle_position[lane.index] = len(self.idle)
+            self.idle.append(lane.index)
+        elif not is_idle and position is not None:
+            last = self.idle.pop()
+            if last != lane.index:
+                self.idle[position] = last
+                self.idle_position[last] = position
+            del self.idle_position[lane.index]
+
+    def _pick_idle(self):
+        if self.idle:
+            return self.lanes[self.stream.choice(self.idle)]
+        return self.stream.choice(self.lanes)
+
+    def _pick_first(self):
+        return self.lanes[0]
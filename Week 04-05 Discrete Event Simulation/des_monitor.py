@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Time-weighted monitors for the SimPy models
+
+A level such as trunk lines in use, busy servers or queue length is only
+recorded when it changes.  The time spent at every level, the area under the
+level per reporting interval and the number of blocked arrivals are kept
+online, so there is nothing to post-process and the statistics are time
+weighted (a count-weighted histogram of the level seen by arrivals is not).
+
+MonitoredResource is a drop-in simpy Resource with two of these monitors, one
+for busy servers and one for the queue length.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import math
+import numpy as np
+import simpy
+
+#####################################################
+# Classes
+
+class LevelMonitor(object):
+    """Time-weighted statistics of an integer level with a capacity
+       env = simpy Environment
+       capacity = highest possible level (trunk lines, servers), None if unbounded (queues)
+       interval = length of the intervals for the per-interval averages
+       level = level at the current time"""
+    def __init__(self, env, capacity, interval=10, level=0):
+        self.env = env
+        self.capacity = capacity
+        self.interval = interval
+        self.level = level
+        self.last_time = env.now
+        self.start_time = env.now
+        self.time_at_level = [0.0] * ((capacity if capacity is not None else level) + 1)
+        self.interval_area = []
+        self.arrivals = 0
+        self.blocked = 0
+
+    def _accumulate(self, now):
+        t0, level = self.last_time, self.level
+        if now <= t0:
+            return
+        if level >= len(self.time_at_level):
+            self.time_at_level.extend([0.0] * (level + 1 - len(self.time_at_level)))
+        self.time_at_level[level] += now - t0
+        self.last_time = now
+        if level == 0:
+            return
+
+        # Area under the level, split over the reporting intervals
+        area = self.interval_area
+        k, k_end = int(t0 // self.interval), int(now // self.interval)
+        if k_end >= len(area):
+            area.extend([0.0] * (k_end + 1 - len(area)))
+        while k < k_end:
+            end = (k + 1) * self.interval
+            area[k] += level * (end - t0)
+            t0 = end
+            k += 1
+        area[k] += level * (now - t0)
+
+    def add(self, delta):
+        """Changes the level by delta at the current time"""
+        self._accumulate(self.env.now)
+        self.level += delta
+
+    def set(self, level):
+        """Sets the level at the current time, nothing is recorded if unchanged"""
+        if level != self.level:
+            self._accumulate(self.env.now)
+            self.level = level
+
+    def available(self):
+        return self.capacity is None or self.level < self.capacity
+
+    def seize(self):
+        """Counts an arrival and takes one unit if available
+           returns False (and counts a blocked arrival) at capacity"""
+        self.arrivals += 1
+        if self.available():
+            self.add(1)
+            return True
+        self.blocked += 1
+        return False
+
+    def results(self, until=None):
+        """Statistics from the start to until (the current time by default)
+           returns a dict with the time-weighted mean level, the fraction of
+           time at each level, the average level per interval, the blocking
+           probability of arrivals and the fraction of time at capacity"""
+        self._accumulate(self.env.now if until is None else until)
+        duration = self.last_time - self.start_time
+        time_at_level = np.array(self.time_at_level)
+        levels = np.arange(len(time_at_level))
+
+        n_intervals = max(int(math.ceil(self.last_time / self.interval)), 1)
+        area = np.zeros(n_intervals)
+        area[:min(len(self.interval_area), n_intervals)] = self.interval_area[:n_intervals]
+        interval_length = np.full(n_intervals, float(self.interval))
+        interval_length[-1] = self.last_time - (n_intervals - 1) * self.interval
+
+        return {'mean': (time_at_level * levels).sum() / duration if duration > 0 else math.nan,
+                'histogram': time_at_level / duration if duration > 0 else time_at_level,
+                'interval_means': area / np.maximum(interval_length, 1e-12),
+                'arrivals': self.arrivals,
+                'blocked': self.blocked,
+                'blocking_probability': self.blocked / self.arrivals if self.arrivals else math.nan,
+                'time_at_capacity': (time_at_level[self.capacity] / duration
+                                     if duration > 0 and self.capacity is not None else math.nan)}
+
+class MonitoredResource(simpy.Resource):
+    """simpy Resource that keeps time-weighted busy servers and queue length
+       The levels are updated from the resource's own trigger methods, so
+       they are recorded only when a request is granted, queued, cancelled
+       (reneging) or released, and no polling process is needed
+       env = simpy Environment
+       capacity = number of servers
+       interval = length of the intervals for the profiles (60 = hourly)"""
+    def __init__(self, env, capacity=1, interval=60):
+        super().__init__(env, capacity)
+        self.busy = LevelMonitor(env, capacity, interval)
+        self.waiting = LevelMonitor(env, None, interval)
+
+    def _update(self):
+        # Called on every trigger, so the unchanged case is kept cheap
+        busy, waiting = self.busy, self.waiting
+        if len(self.users) != busy.level:
+            busy.set(len(self.users))
+        if len(self.put_queue) != waiting.level:
+            waiting.set(len(self.put_queue))
+
+    def _trigger_put(self, get_event):
+        super()._trigger_put(get_event)
+        self._update()
+
+    def _trigger_get(self, put_event):
+        super()._trigger_get(put_event)
+        self._update()
+
+    def results(self, until=None):
+        """Utilization and queue statistics from the start to until
+           returns a dict with the utilization, average busy servers, average
+           queue length, the time with a queue and the per-interval profiles"""
+        busy = self.busy.results(until)
+        waiting = self.waiting.results(until)
+        return {'utilization': busy['mean'] / self.capacity,
+                'busy': busy['mean'],
+                'queue': waiting['mean'],
+                'time_with_queue': 1.0 - waiting['histogram'][0],
+                'utilization_profile': busy['interval_means'] / self.capacity,
+                'queue_profile': waiting['interval_means']}
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Simulation optimization with adaptive replication allocation
+
+Picks the cheapest configuration whose simulated KPIs meet their limits (for
+example abandonment at most 5%) from a list of candidates with known costs.
+Running every candidate for the same large number of replications wastes most
+of the runs on candidates that are clearly infeasible, or clearly more
+expensive than one already known to be feasible.  Instead (OCBA for
+feasibility, in the spirit of Lee et al. 2012):
+
+    1. every candidate gets a few replications
+    2. each candidate and limit gets a one-sided t test at level
+       alpha / (k m L) (Bonferroni over the k candidates, m limits and L
+       looks, below): feasible, infeasible or undecided
+    3. candidates dearer than the cheapest feasible one are dropped
+    4. the next batch of replications goes to the undecided candidates that
+       could still be the answer, in proportion to (std / distance to the
+       limit)^2, so close calls get the runs
+    5. repeat until the cheapest feasible candidate is known
+
+The tests are repeated after every batch.  A candidate's tests only change
+when it gets more replications, so it is looked at with at most
+L = max_replications - initial_replications + 1 different sample sizes, and
+the Bonferroni split over all k m L tests bounds the chance that any
+classification of the whole run is wrong by alpha.  A run that stops with
+every cheaper candidate found infeasible has picked the cheapest feasible
+candidate with probability at least 1 - alpha.  The price is wide tests: many
+candidates or a large max_replications need more replications to decide.
+Replication i of every candidate uses the same seed (common random numbers)
+and each batch runs on the process pool, so the choice does not depend on the
+number of workers.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from des_runner import replication_seed, run_tasks
+
+############################################################
+# Functions
+
+def _classify(kpis, constraints, level, max_replications):
+    # 'feasible', 'infeasible' or 'undecided' and the OCBA weight of a candidate,
+    # one-sided t tests at the given level (the same quantile as the half widths)
+    n = len(kpis)
+    t_value = stats.t.ppf(1 - level, n - 1)
+    weight = 0.0
+    status = 'feasible'
+    for kpi, limit in constraints.items():
+        values = np.array([k[kpi] for k in kpis], dtype=float)
+        mean = values.mean()
+        std = values.std(ddof=1) if n > 1 else np.inf
+        distance = limit - mean
+        if std == 0:
+            t = np.inf if distance > 0 else -np.inf if distance < 0 else 0.0
+        else:
+            t = distance / (std / np.sqrt(n))
+        if t < -t_value:
+            return 'infeasible', 0.0
+        if t <= t_value:
+            status = 'undecided'
+            weight = max(weight, (std / max(abs(distance), 1e-12)) ** 2)
+    if status == 'undecided' and n >= max_replications:
+        status = 'unresolved'
+    return status, weight
+
+def select_cheapest_feasible(run_replication, candidates, costs, replication_kpis,
+                             constraints, random_seed, alpha=0.05,
+                             initial_replications=5, batch=None,
+                             max_replications=50, budget=None, workers=1, cache=None):
+    """Cheapest candidate whose KPIs meet their upper limits
+       run_replication = run_replication(replication, seed, *candidate)
+       candidates = list of argument tuples, one per configuration
+       costs = deterministic cost of every candidate
+       replication_kpis = function(result of one replication) -> dict of KPI -> value
+       constraints = dict of KPI -> upper limit of its mean
+       alpha = error level of the whole procedure, split over all candidates,
+               limits and looks
+       initial_replications = replications of every candidate in the first round
+       batch = replications added per round (default: one per worker, at least 4)
+       max_replications = most replications of one candidate
+       budget = most replications in total (None = no limit)
+       cache = ResultCache or Checkpoint for the replications (see des_runner)
+       returns (index of the chosen candidate or None, True if every cheaper
+       candidate was found infeasible, so the choice holds at level alpha,
+       DataFrame with one row per candidate:
+       cost, replications, KPI means and half widths, status)"""
+    k = len(candidates)
+    initial_replications = max(initial_replications, 2)
+    looks = max(max_replications - initial_replications + 1, 1)
+    tests = k * len(constraints) * looks
+    seeds = {}
+    kpis = [[] for _ in range(k)]
+    batch = batch or max(workers or 1, 4)
+    order = np.argsort(costs, kind='stable')
+
+    def run(allocation):
+        tasks = []
+        owners = []
+        for i, extra in allocation.items():
+            for r in range(len(kpis[i]), len(kpis[i]) + extra):
+                if r not in seeds:
+                    seeds[r] = replication_seed(random_seed, r)
+                tasks.append((run_replication, r, seeds[r], tuple(candidates[i])))
+                owners.append(i)
+        for i, result in zip(owners, run_tasks(tasks, workers, cache)):
+            kpis[i].append(replication_kpis(result))
+
+    run({i: initial_replications for i in range(k)})
+    while True:
+        status = {}
+        weight = {}
+        for i in range(k):
+            status[i], weight[i] = _classify(kpis[i], constraints, alpha / tests, max_replications)
+
+        # Dearer than the cheapest feasible candidate: dominated
+        chosen = next((i for i in order if status[i] == 'feasible'), None)
+        if chosen is not None:
+            for i in order:
+                if i != chosen and costs[i] >= costs[chosen] and status[i] == 'undecided':
+                    status[i] = 'dominated'
+        open_candidates = [i for i in order if status[i] == 'undecided']
+        used = sum(len(x) for x in kpis)
+        if not open_candidates or (budget is not None and used >= budget):
+            break
+
+        # OCBA: the next runs go where (std / distance to the limit)^2 per run is largest
+        allocation = {}
+        n = {i: len(kpis[i]) for i in open_candidates}
+        room = batch if budget is None else min(batch, budget - used)
+        for _ in range(room):
+            i = max((j for j in open_candidates if n[j] < max_replications),
+                    key=lambda j: weight[j] / n[j], default=None)
+            if i is None:
+                break
+            n[i] += 1
+            allocation[i] = allocation.get(i, 0) + 1
+        if not allocation:
+            break
+        run(allocation)
+
+    rows = []
+    for i in range(k):
+        row = {'Candidate': i, 'Cost': costs[i], 'Replications': len(kpis[i]),
+               'Status': status[i]}
+        for kpi in constraints:
+            values = np.array([x[kpi] for x in kpis[i]], dtype=float)
+            row[kpi] = values.mean()
+            row[kpi + ' Half Width'] = (stats.t.ppf(1 - alpha / tests, len(values) - 1)
+                                        * values.std(ddof=1) / np.sqrt(len(values)))
+        rows.append(row)
+    table = pd.DataFrame(rows).set_index('Candidate')
+    table['Chosen'] = table.index == chosen
+    decided = chosen is not None and all(status[i] == 'infeasible' for i in range(k)
+                                         if costs[i] < costs[chosen])
+    return chosen, decided, table
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Cancelable patience timers for reneging
+
+The usual SimPy reneging pattern, yield req | env.timeout(patience), leaves
+the patience timeout on the event heap until it expires, even when the call
+was answered long before.  Under load the heap fills with these stale
+timeouts and every push and pop pays for them.
+
+PatienceTimers keeps the deadlines in its own heap and has a timeout on the
+event heap only for the earliest one (plus the occasional superseded wake-up).
+A deadline that is cancelled when the call is answered is skipped when it
+comes up, so an answered call leaves nothing behind on the event heap.
+
+The trade-off: the event heap stays smaller, but a reneging call costs a
+wake-up plus its own event, and an earlier deadline can supersede a pending
+wake-up, so more events are scheduled.  In the call center model the plain
+timeouts were faster at every load tried (up to 74% abandonment, 2000 trunk
+lines), so the call center leaves PATIENCE_TIMERS off by default; the
+timers only pay off when the event heap itself is very large.
+
+    patience = timers.start(self.patience)
+    results = yield req | patience
+    if req in results:
+        timers.cancel(patience)
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import heapq
+import itertools
+import simpy
+
+#####################################################
+# Classes
+
+class PatienceTimers(object):
+    """Patience deadlines with at most a few timeouts on the event heap
+       env = simpy Environment
+       start(patience) returns an event that succeeds after patience unless
+       it is cancelled first"""
+    def __init__(self, env):
+        self.env = env
+        self.deadlines = []       # heap of [time, id, event], event None once cancelled
+        self.entries = {}         # event -> its deadlines entry
+        self.wake_ups = []        # heap of the times of the pending timeouts
+        self.ids = itertools.count()
+        self.cancelled = 0
+
+    def start(self, patience):
+        """Event that succeeds patience time units from now"""
+        event = simpy.Event(self.env)
+        deadline = self.env.now + patience
+        entry = [deadline, next(self.ids), event]
+        self.entries[event] = entry
+        heapq.heappush(self.deadlines, entry)
+        if not self.wake_ups or deadline < self.wake_ups[0]:
+            self._wake_up_at(deadline)
+        return event
+
+    def cancel(self, event):
+        """Skips the deadline of event, nothing is left on the event heap"""
+        entry = self.entries.pop(event, None)
+        if entry is None:
+            return
+        entry[2] = None
+        self.cancelled += 1
+        # Compact once most of the kept deadlines are dead
+        if self.cancelled > 64 and 2 * self.cancelled > len(self.deadlines):
+            self.deadlines = [e for e in self.deadlines if e[2] is not None]
+            heapq.heapify(self.deadlines)
+            self.cancelled = 0
+
+    def _wake_up_at(self, time):
+        heapq.heappush(self.wake_ups, time)
+        timeout = self.env.timeout(time - self.env.now)
+        timeout.callbacks.append(self._expire)
+
+    def _expire(self, timeout):
+        heapq.heappop(self.wake_ups)
+        now = self.env.now
+        deadlines = self.deadlines
+        while deadlines and (deadlines[0][0] <= now or deadlines[0][2] is None):
+            _, _, event = heapq.heappop(deadlines)
+            if event is None:
+                self.cancelled -= 1
+            else:
+                del self.entries[event]
+                event.succeed()
+        if deadlines and (not self.wake_ups or deadlines[0][0] < self.wake_ups[0]):
+            self._wake_up_at(deadlines[0][0])
+
+class CountingEnvironment(simpy.Environment):
+    """simpy Environment that counts the events it schedules and the
+       largest size of its event heap"""
+    def __init__(self, initial_time=0):
+        super().__init__(initial_time)
+        self.scheduled = 0
+        self.peak_queue = 0
+
+    def schedule(self, event, priority=simpy.core.NORMAL, delay=0):
+        super().schedule(event, priority, delay)
+        self.scheduled += 1
+        if len(self._queue) > self.peak_queue:
+            self.peak_queue = len(self._queue)
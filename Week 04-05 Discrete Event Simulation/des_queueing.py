@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Analytic queueing approximations for screening model configurations
+
+Steady-state formulas give the average wait of a simple queue in microseconds,
+so thousands of lane / arrival combinations can be screened before anything
+is simulated, and configurations that can never reach steady state (traffic
+intensity rho >= 1) are flagged up front.
+
+    M/G/1   Pollaczek-Khinchine, exact for Poisson arrivals
+    M/G/c   Allen-Cunneen, Erlang C scaled by (ca^2 + cs^2) / 2, exact for
+            M/M/c and equal to Pollaczek-Khinchine for c = 1
+    M/M/c+M Erlang A, callers abandon after an exponential patience
+    M/G/c/c Erlang B, blocking of a pool of lines without a queue
+    network open network of M/G/c stations with product routing (Jackson
+            decomposition), exact when every product has the same exponential
+            time at a station
+
+Every function takes scalars or NumPy arrays (broadcast against each other)
+and returns the same, so a whole grid is evaluated in one call:
+
+    q = queue_approximation(1 / 0.33333, 1.0, 0.25, servers=[1, 2, 3, 4])
+    q['Wq']         # average wait for 1 .. 4 servers
+
+The simulated means of a run can then be checked against the formulas with
+compare_with_simulation.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import numpy as np
+import pandas as pd
+from scipy.special import gammaln, logsumexp, ndtr
+
+# Lane policies that look at the queues, no closed form, their wait lies between
+# independent lanes and one pooled queue
+SHORTEST_QUEUE_POLICIES = ('greedy', 'lazy', 'idle')
+
+############################################################
+# Functions
+
+def _out(x):
+    # 0-d arrays back to scalars
+    return x[()] if isinstance(x, np.ndarray) and x.ndim == 0 else x
+
+def censored_normal_moments(mu, sigma, minimum):
+    """Mean and squared coefficient of variation of max(X, minimum), X normal
+       (the checkout times of the cashier models)
+       returns (mean, scv)"""
+    mu, sigma, minimum = np.broadcast_arrays(*(np.asarray(x, dtype=float)
+                                               for x in (mu, sigma, minimum)))
+    a = (minimum - mu) / sigma
+    below = ndtr(a)
+    density = np.exp(-0.5 * a * a) / np.sqrt(2 * np.pi)
+    mean = minimum * below + mu * (1 - below) + sigma * density
+    second = (minimum ** 2 * below + (mu ** 2 + sigma ** 2) * (1 - below)
+              + sigma * (mu + minimum) * density)
+    return _out(mean), _out(second / mean ** 2 - 1)
+
+def erlang_b(servers, offered_load):
+    """Probability that all servers are busy in M/G/c/c (Erlang loss formula)
+       servers = number of servers (integers)
+       offered_load = arrival rate * mean service time (Erlangs)"""
+    servers, offered_load = np.broadcast_arrays(np.asarray(servers, dtype=int),
+                                                np.asarray(offered_load, dtype=float))
+    # B(k) = a B(k-1) / (k + a B(k-1)), run up to the largest number of servers
+    b = np.ones(servers.shape)
+    for k in range(1, int(servers.max(initial=0)) + 1):
+        step = k <= servers
+        b = np.where(step, offered_load * b / (k + offered_load * b), b)
+    return _out(b)
+
+def erlang_c(servers, offered_load):
+    """Probability of waiting in M/M/c (Erlang C), 1 when unstable"""
+    servers = np.asarray(servers, dtype=int)
+    offered_load = np.asarray(offered_load, dtype=float)
+    b = np.asarray(erlang_b(servers, offered_load))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c = servers * b / (servers - offered_load * (1 - b))
+    return _out(np.where(offered_load < servers, c, 1.0))
+
+def queue_approximation(arrival_rate, service_mean, service_scv=1.0, servers=1,
+                        arrival_scv=1.0):
+    """Steady-state averages of a GI/G/c queue (Allen-Cunneen)
+       arrival_rate = customers per time unit
+       service_mean = mean service time
+       service_scv = squared coefficient of variation of the service time
+                     (1 = exponential, 0 = constant)
+       servers = servers sharing the queue
+       arrival_scv = squared coefficient of variation of the interarrival times
+                     (1 = Poisson)
+       returns a dict of 'Utilization', 'Wq', 'W', 'Lq', 'L' and 'Stable'
+       (Wq, W, Lq and L are inf where the utilization is 1 or more)"""
+    arrival_rate, service_mean, service_scv, servers, arrival_scv = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in
+          (arrival_rate, service_mean, service_scv, servers, arrival_scv)))
+    offered_load = arrival_rate * service_mean
+    utilization = offered_load / servers
+    stable = utilization < 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wait_mmc = erlang_c(servers, offered_load) * service_mean / (servers - offered_load)
+        wq = np.where(stable, wait_mmc * (arrival_scv + service_scv) / 2, np.inf)
+    w = wq + service_mean
+    return {'Utilization': _out(utilization),
+            'Wq': _out(wq),
+            'W': _out(w),
+            'Lq': _out(arrival_rate * wq),
+            'L': _out(arrival_rate * w),
+            'Stable': _out(stable)}
+
+def erlang_a(servers, arrival_rate, service_mean, patience_mean, wait_limit=None):
+    """Steady-state averages of a queue with abandonment, M/M/c+M (Erlang A)
+       servers = agents answering the queue
+       arrival_rate = calls per time unit
+       service_mean = mean talk time
+       patience_mean = mean patience, callers still waiting after an
+                       exponential patience of this mean abandon
+       wait_limit = answer time target of the service level (None = no service level)
+       returns a dict of arrays:
+           'Abandonment'    fraction of calls that abandon
+           'Wait'           average wait of all calls (ASA including abandons)
+           'Queue'          average number waiting
+           'P Wait'         fraction of calls that have to wait
+           'Service Level'  fraction of calls answered within wait_limit (NaN
+                            without wait_limit)
+           'Utilization'    fraction of time the agents are busy
+       The queue is truncated where the state probabilities become negligible
+       (the abandonments always keep it stable)"""
+    servers, arrival_rate, service_mean, patience_mean, wait_limit = np.broadcast_arrays(
+        *(np.asarray(x, dtype=float) for x in
+          (servers, arrival_rate, service_mean, patience_mean,
+           np.nan if wait_limit is None else wait_limit)))
+    shape = servers.shape
+    n = servers.ravel().astype(int)[:, None]
+    lam = arrival_rate.ravel()[:, None]
+    mu = 1.0 / service_mean.ravel()[:, None]
+    theta = 1.0 / patience_mean.ravel()[:, None]
+    t = wait_limit.ravel()[:, None]
+
+    # Log state probabilities, k busy agents then j waiting calls
+    k = np.arange(int(n.max(initial=0)) + 1)[None, :]
+    log_busy = np.where(k <= n, k * np.log(lam / mu) - gammaln(k + 1), -np.inf)
+    drift = lam / theta
+    queue_length = int(np.max(drift + 10 * np.sqrt(drift)) + 20)
+    j = np.arange(1, queue_length + 1)[None, :]
+    log_top = np.take_along_axis(log_busy, n, axis=1)
+    log_queue = log_top + np.cumsum(np.log(lam / (n * mu + j * theta)), axis=1)
+    log_norm = logsumexp(np.concatenate([log_busy, log_queue], axis=1), axis=1, keepdims=True)
+    p_top = np.exp(log_top - log_norm)
+    p_queue = np.exp(log_queue - log_norm)
+
+    p_wait = p_top + p_queue.sum(axis=1, keepdims=True)
+    queue = (j * p_queue).sum(axis=1, keepdims=True)
+    abandonment = theta * queue / lam
+
+    # An arrival that finds j - 1 calls waiting is in position j.  The
+    # positions move up at n mu + (j - 1) theta (service or abandonment
+    # ahead) and the caller abandons at theta; the fraction answered within t
+    # comes from the uniformized chain of positions
+    service_level = np.full_like(lam, np.nan)
+    if not np.isnan(t).all():
+        forward = n * mu + (j - 1) * theta
+        rate = forward[:, -1:] + theta
+        move, stay = forward / rate, 1 - (forward + theta) / rate
+        mass = np.concatenate([p_top, p_queue[:, :-1]], axis=1)
+        answered = np.zeros_like(lam)
+        mean_jumps = rate * t
+        log_mean = np.log(np.maximum(mean_jumps, 1e-300))
+        within = np.zeros_like(lam)
+        for m in range(1, int(np.nanmax(mean_jumps + 10 * np.sqrt(mean_jumps))) + 11):
+            moved = mass * move
+            answered += moved[:, :1]
+            mass *= stay
+            mass[:, :-1] += moved[:, 1:]
+            within += np.exp(m * log_mean - mean_jumps - gammaln(m + 1)) * answered
+        service_level = 1 - p_wait + within
+
+    result = {'Abandonment': abandonment,
+              'Wait': queue / lam,
+              'Queue': queue,
+              'P Wait': p_wait,
+              'Service Level': service_level,
+              'Utilization': lam * (1 - abandonment) / (n * mu)}
+    return {key: _out(value.reshape(shape)) for key, value in result.items()}
+
+def jackson_network(arrival_rates, routing, service_means, servers):
+    """Steady-state averages of an open network of multi-server stations
+       arrival_rates = external arrivals per time unit of each product, shape (P,),
+                       every product enters at the first station
+       routing = routing[..., p, i, j], probability that product p goes from
+                 station i to station j next (a row sums to at most 1, the rest
+                 leaves), shape (..., P, S, S) with any leading grid dimensions
+       service_means = mean (exponential) time of product p at station s, (P, S)
+       servers = servers per station, shape (..., S)
+       returns a dict of arrays over the grid dimensions:
+           'Visits'       expected visits of every product to every station (..., P, S)
+           'Arrival Rate' effective arrival rate of every station (..., S)
+           'Utilization', 'Wq', 'Lq', 'Stable' of every station (..., S)
+           'Flow Time'    expected time in the network of every product (..., P)
+       The visits solve v = e + v R for every product.  A station serving
+       several products has hyperexponential times, its wait comes from
+       queue_approximation with their mean and squared coefficient of variation"""
+    arrival_rates = np.asarray(arrival_rates, dtype=float)
+    routing = np.asarray(routing, dtype=float)
+    service_means = np.asarray(service_means, dtype=float)
+    stations = routing.shape[-1]
+
+    # v (I - R) = e, solved as (I - R)^T v^T = e^T for every product and grid point
+    entry = np.zeros(routing.shape[:-1])
+    entry[..., 0] = 1.0
+    transposed = np.swapaxes(np.eye(stations) - routing, -1, -2)
+    visits = np.linalg.solve(transposed, entry[..., None])[..., 0]
+
+    flow = arrival_rates[:, None] * visits                  # (..., P, S)
+    station_rate = flow.sum(axis=-2)                        # (..., S)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(station_rate[..., None, :] > 0, flow / station_rate[..., None, :], 0.0)
+        mean = (share * service_means).sum(axis=-2)
+        second = (share * 2 * service_means ** 2).sum(axis=-2)
+        scv = np.where(mean > 0, second / mean ** 2 - 1, 1.0)
+    stations_q = queue_approximation(station_rate, np.where(mean > 0, mean, 1.0), scv, servers)
+
+    wq = np.where(station_rate > 0, stations_q['Wq'], 0.0)
+    visited = visits > 0
+    flow_time = np.where(visited, visits * (wq[..., None, :] + service_means), 0.0).sum(axis=-1)
+    return {'Visits': visits,
+            'Arrival Rate': station_rate,
+            'Utilization': np.where(station_rate > 0, stations_q['Utilization'], 0.0),
+            'Wq': wq,
+            'Lq': station_rate * wq,
+            'Stable': np.asarray(stations_q['Stable']) | (station_rate == 0),
+            'Flow Time': flow_time}
+
+def lane_approximation(interarrival_mean, lanes, servers, service_mean, service_scv,
+                       policy='random'):
+    """Steady-state averages per customer of a store with parallel checkout lanes
+       interarrival_mean = mean time between (Poisson) arrivals to the store
+       lanes = number of lanes, each with its own queue
+       servers = cashiers per lane
+       policy = lane policy (see des_lanes): 'random' splits the Poisson stream
+                exactly, 'round_robin' gives every lane Erlang arrivals and
+                'first' sends everyone to one lane.  The SHORTEST_QUEUE_POLICIES
+                are treated as 'random', an upper bound on their wait
+       returns the dict of queue_approximation, plus 'Wq Pooled' and 'W Pooled'
+       of one queue shared by all lanes * servers cashiers (the lower bound)"""
+    arrival_rate = 1.0 / np.asarray(interarrival_mean, dtype=float)
+    lanes = np.asarray(lanes, dtype=float)
+    if policy == 'first':
+        result = queue_approximation(arrival_rate, service_mean, service_scv, servers)
+    elif policy == 'round_robin':
+        result = queue_approximation(arrival_rate / lanes, service_mean, service_scv,
+                                     servers, 1.0 / lanes)
+    else:
+        result = queue_approximation(arrival_rate / lanes, service_mean, service_scv, servers)
+    pooled = queue_approximation(arrival_rate, service_mean, service_scv,
+                                 lanes * np.asarray(servers))
+    result['Wq Pooled'] = pooled['Wq']
+    result['W Pooled'] = pooled['W']
+    return result
+
+def compare_with_simulation(analytic, simulated, kpis):
+    """Analytic against simulated averages
+       analytic = dict from queue_approximation (scalars)
+       simulated = simulated means (e.g. df.mean()), indexed by KPI name
+       kpis = dict of KPI name -> analytic key, e.g. {'Wait Time': 'Wq'}
+       returns a DataFrame indexed by KPI with the difference in percent"""
+    rows = []
+    for kpi, key in kpis.items():
+        value = float(analytic[key])
+        rows.append([kpi, value, simulated[kpi], 100 * (simulated[kpi] - value) / value
+                     if value else np.nan])
+    return pd.DataFrame(rows, columns=['KPI','Analytic','Simulated',
+                                       'Difference %']).set_index('KPI')
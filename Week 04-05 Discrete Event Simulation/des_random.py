@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Random number streams for the SimPy models
+
+A model that draws everything from the global random / np.random state mixes
+the random sources in whatever order events happen.  Change one parameter and
+every later customer sees different numbers.  Giving each random source its own
+stream keeps the n-th arrival, the n-th segment, etc. the same across scenarios
+run with the same seed (common random numbers), so paired comparisons need far
+fewer replications.
+
+UniformStream draws every variate by inverse transform from a single uniform,
+so a run can be mirrored exactly with the complementary uniforms 1-U
+(antithetic variates).  Antithetic pairs only stay in step when each random
+source has its own stream (RandomStreams) and every entity takes a fixed
+number of draws from it.
+
+A VariateTape generates the variates of one distribution in NumPy blocks
+(vectorized inverse transforms of one uniform per variate, so antithetic runs
+still work) and hands them out one at a time, which is much cheaper than a
+Python RNG call per event.  The variates a run used can be saved and replayed,
+e.g. to feed several model configurations the identical customer stream.
+With alias_transform a tape samples a categorical distribution (segments) in
+constant time per draw.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import bisect
+import itertools
+import math
+import os
+import random
+import numpy as np
+from scipy.special import ndtri
+from statistics import NormalDist
+
+#####################################################
+# Classes
+
+class RandomStreams(object):
+    """One UniformStream per random source
+       seed = seed of the replication
+       names = list of random sources, streams are assigned by position so
+               new sources should be added at the end of the list
+       antithetic = every stream uses the complementary uniforms
+       streams['Arrivals'].expovariate(...) etc."""
+    def __init__(self, seed, names, antithetic=False):
+        children = np.random.SeedSequence(seed).spawn(len(names))
+        self.seeds = {name: int(child.generate_state(1)[0])
+                      for name, child in zip(names, children)}
+        self.antithetic = antithetic
+        self.streams = {name: UniformStream(self.seeds[name], antithetic)
+                        for name in names}
+
+    def __getitem__(self, name):
+        return self.streams[name]
+
+    def tape(self, name, transform, block=4096, record=False):
+        """VariateTape seeded like the stream name (in place of the stream)"""
+        return VariateTape(self.seeds[name], transform, block, self.antithetic, record)
+
+class UniformStream(object):
+    """Random variates from one uniform stream by inverse transform
+       seed = seed of the stream
+       antithetic = use 1-U in place of every uniform U
+       A pair of streams with the same seed, one of them antithetic, sees
+       complementary uniforms for every draw as long as both runs ask for
+       the same sequence of variates."""
+    def __init__(self, seed, antithetic=False):
+        self.rng = random.Random(seed)
+        self.antithetic = antithetic
+
+    def random(self):
+        # Uniform on the open interval (0, 1), symmetric so 1-U is in it as well
+        u = (self.rng.getrandbits(53) + 0.5) / 9007199254740992.0
+        return 1.0 - u if self.antithetic else u
+
+    def expovariate(self, lambd):
+        return -math.log(1.0 - self.random()) / lambd
+
+    def normalvariate(self, mu, sigma):
+        return NormalDist(mu, sigma).inv_cdf(self.random())
+
+    def choices(self, population, weights):
+        # One uniform against the cumulative weights, k = 1 only
+        cum_weights = list(itertools.accumulate(weights))
+        i = bisect.bisect(cum_weights, self.random() * cum_weights[-1])
+        return [population[min(i, len(population) - 1)]]
+
+    def choice(self, seq):
+        return seq[min(int(self.random() * len(seq)), len(seq) - 1)]
+
+    def shuffle(self, x):
+        # Fisher-Yates, one uniform per position
+        for i in reversed(range(1, len(x))):
+            j = min(int(self.random() * (i + 1)), i)
+            x[i], x[j] = x[j], x[i]
+
+class VariateTape(object):
+    """Variates of one distribution generated in blocks and read one at a time
+       seed = seed of the tape, None for a replayed tape (see from_values)
+       transform = function of an array of uniforms on (0, 1) -> array of variates,
+                   e.g. exponential_transform(mean)
+       block = variates generated per refill
+       antithetic = use 1-U in place of every uniform U
+       record = keep the variates so the used part can be saved (variates())"""
+    def __init__(self, seed, transform=None, block=4096, antithetic=False, record=False):
+        self.rng = np.random.default_rng(seed) if seed is not None else None
+        self.transform = transform
+        self.block = block
+        self.antithetic = antithetic
+        self.blocks = [] if record else None
+        self.buffer = []
+        self.position = 0
+        self.offset = 0      # variates handed out before the current buffer
+
+    @classmethod
+    def from_values(cls, values):
+        """Tape that replays saved variates, exactly and only once"""
+        tape = cls(None, record=True)
+        tape.blocks.append(np.asarray(values, dtype=float))
+        tape.buffer = tape.blocks[0].tolist()
+        return tape
+
+    def _refill(self):
+        self.offset += len(self.buffer)
+        if self.rng is None:
+            raise EOFError("Variate tape exhausted after %d variates" % self.offset)
+        # Same open-interval uniforms as UniformStream, 53 random bits each
+        u = (self.rng.integers(0, 1 << 53, self.block) + 0.5) / 9007199254740992.0
+        values = self.transform(1.0 - u if self.antithetic else u)
+        if self.blocks is not None:
+            self.blocks.append(values)
+        self.buffer = values.tolist()
+        self.position = 0
+
+    def draw(self):
+        """Next variate of the tape"""
+        if self.position == len(self.buffer):
+            self._refill()
+        value = self.buffer[self.position]
+        self.position += 1
+        return value
+
+    def __len__(self):
+        # Variates handed out so far
+        return self.offset + self.position
+
+    def variates(self):
+        """The variates handed out so far (record=True only)"""
+        if self.blocks is None:
+            raise ValueError("Variate tape was not recorded (record=True)")
+        if not self.blocks:
+            return np.empty(0)
+        return np.concatenate(self.blocks)[:len(self)]
+
+############################################################
+# Functions
+
+def exponential_transform(mean):
+    """Inverse transform of an exponential with the given mean"""
+    return lambda u: -mean * np.log1p(-u)
+
+def normal_transform(mu, sigma, minimum=None):
+    """Inverse transform of a normal, raised to minimum if given (truncation)"""
+    if minimum is None:
+        return lambda u: mu + sigma * ndtri(u)
+    return lambda u: np.maximum(mu + sigma * ndtri(u), minimum)
+
+def alias_tables(weights):
+    """Walker / Vose alias tables of a discrete distribution
+       returns (probability of keeping column i, alias of column i)"""
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=float)
+    scaled = scaled / scaled.sum() * n
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] -= 1.0 - scaled[s]
+        (small if scaled[l] < 1.0 else large).append(l)
+    # Whatever is left has probability 1 up to rounding
+    return prob, alias
+
+def alias_transform(population, weights):
+    """Inverse transform of a categorical distribution with alias tables
+       One uniform per draw: its integer part (times n) picks the column and
+       the fraction decides between the column and its alias"""
+    prob, alias = alias_tables(weights)
+    values = np.empty(len(population), dtype=object)
+    values[:] = list(population)
+    n = len(population)
+    def transform(u):
+        scaled = u * n
+        column = np.minimum(scaled.astype(np.int64), n - 1)
+        keep = scaled - column < prob[column]
+        return values[np.where(keep, column, alias[column])]
+    return transform
+
+def save_tapes(path, tapes):
+    """Saves the used variates of a dict of recorded tapes to one .npz file"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    np.savez(path, **{name: tape.variates() for name, tape in tapes.items()})
+
+def load_tapes(path):
+    """Tapes saved with save_tapes, as a dict of name -> replaying VariateTape"""
+    with np.load(path) as data:
+        return {name: VariateTape.from_values(data[name]) for name in data.files}
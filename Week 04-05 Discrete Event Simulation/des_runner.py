@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Replication runner for the SimPy models
+
+Runs independent replications of a model, either one after another or spread
+across a process pool.  Every replication gets its own seed derived from the
+run seed and the replication index, so the results do not depend on how many
+workers were used or in which order the replications finished.
+
+Usage from a model script:
+
+    def run_replication(replication, seed):
+        random.seed(seed)
+        ...
+        return tallies
+
+    if __name__ == '__main__':
+        results = run_replications(run_replication, run_params.replications,
+                                   run_params.random_seed, run_params.workers)
+
+The guard is required on Windows (and macOS) where the worker processes
+re-import the model script.
+
+Every runner takes an optional cache (des_cache.ResultCache or Checkpoint):
+replications already in the cache are read back, only the others are
+simulated, and each one is stored as soon as it finishes, so a run that is
+killed part way keeps the replications it completed.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import os
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from des_stats import kpi_confidence_intervals
+
+############################################################
+# Functions
+
+def replication_seed(random_seed, replication):
+    """Seed for a single replication
+       random_seed = seed for the whole run (run_params.random_seed)
+       replication = replication index (0 based)
+       Uses a numpy SeedSequence so the streams of the replications are
+       statistically independent, and replication i always gets the same seed
+       """
+    ss = np.random.SeedSequence(random_seed, spawn_key=(replication,))
+    return int(ss.generate_state(1)[0])
+
+def replication_seeds(random_seed, replications):
+    """Seeds for replications 0 .. replications-1"""
+    return [replication_seed(random_seed, i) for i in range(replications)]
+
+def _run_task(task):
+    # Top level so it can be pickled and sent to a worker process
+    run_replication, replication, seed, args = task
+    return run_replication(replication, seed, *args)
+
+def _run_completed(tasks, workers):
+    # Yields (task position, result) as each task finishes, in any order
+    if workers is None:
+        workers = os.cpu_count()
+
+    if workers == 1 or len(tasks) <= 1:
+        for i, task in enumerate(tasks):
+            yield i, _run_task(task)
+        return
+
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(tasks)))
+    try:
+        futures = {pool.submit(_run_task, task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    except BaseException:
+        # Do not start the queued tasks once one has failed or the run is interrupted
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+def run_tasks(tasks, workers=1, cache=None):
+    """Runs a list of (run_replication, replication, seed, args) tasks
+       workers = number of processes, 1 runs in this process, None uses all cores
+       cache = ResultCache to read results from and store each new result in
+               as soon as its task finishes
+       returns the results in the same order as the tasks"""
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    if cache is not None:
+        keys = cache.keys(tasks)
+        pending = []
+        for i, key in enumerate(keys):
+            hit, results[i] = cache.get(key)
+            if not hit:
+                pending.append(i)
+
+    for j, result in _run_completed([tasks[i] for i in pending], workers):
+        results[pending[j]] = result
+        if cache is not None:
+            cache.put(keys[pending[j]], result)
+
+    if cache is not None:
+        cache.evict()
+    return results
+
+def run_replications(run_replication, replications, random_seed, workers=1, args=(),
+                     cache=None):
+    """Runs run_replication(replication, seed, *args) for every replication
+       returns the list of results in replication order"""
+    tasks = [(run_replication, i, seed, args)
+             for i, seed in enumerate(replication_seeds(random_seed, replications))]
+    return run_tasks(tasks, workers, cache)
+
+def run_sweep(run_replication, scenarios, replications, random_seed, workers=1,
+              cache=None):
+    """Runs every scenario for every replication on one process pool
+       scenarios = list of argument tuples, run_replication(replication, seed, *args)
+       Replication i uses the same seed in every scenario (common random numbers)
+       returns one list of replication results per scenario, in scenario order"""
+    seeds = replication_seeds(random_seed, replications)
+    tasks = [(run_replication, i, seeds[i], args)
+             for args in scenarios for i in range(replications)]
+    results = run_tasks(tasks, workers, cache)
+    return [results[j * replications:(j + 1) * replications]
+            for j in range(len(scenarios))]
+
+def run_sequential(run_replication, replication_kpis, random_seed, half_width,
+                   relative=True, confidence=0.95, min_replications=5,
+                   max_replications=100, workers=1, args=(), cache=None):
+    """Adds replications until every KPI is estimated precisely enough
+       replication_kpis = function(result of one replication) -> dict of KPI -> value
+       half_width = target confidence interval half-width for every KPI,
+                    a fraction of the KPI mean if relative, otherwise absolute
+       The number of replications to add is estimated from the current
+       half-widths, n_needed = n * (half_width / target)^2, so the stopping
+       point does not depend on the number of workers.
+       returns (results in replication order, DataFrame of KPI intervals)"""
+    results = []
+    kpis = []
+    n_next = min(max(min_replications, 2), max_replications)
+    
+    while True:
+        tasks = [(run_replication, i, replication_seed(random_seed, i), args)
+                 for i in range(len(results), n_next)]
+        new_results = run_tasks(tasks, workers, cache)
+        results.extend(new_results)
+        kpis.extend(replication_kpis(r) for r in new_results)
+        
+        table = kpi_confidence_intervals(kpis, confidence)
+        table['Target'] = half_width * table['Mean'].abs() if relative else half_width
+        table['Met'] = table['Half Width'] <= table['Target']
+        
+        n = len(results)
+        if table['Met'].all() or n >= max_replications:
+            return results, table
+        
+        ratio = (table['Half Width'] / table['Target']).max()
+        n_needed = math.ceil(n * ratio ** 2) if math.isfinite(ratio) else 2 * n
+        n_next = min(max(n_needed, n + 1), max_replications)
+
+def run_antithetic_pairs(run_replication, pairs, random_seed, workers=1, args=(),
+                         cache=None):
+    """Runs replications in antithetic pairs
+       run_replication(replication, seed, antithetic, *args), both runs of pair k
+       use the seed of replication k, the second one with antithetic=True
+       returns (primary results, antithetic results) in pair order"""
+    tasks = []
+    for k, seed in enumerate(replication_seeds(random_seed, pairs)):
+        tasks.append((run_replication, 2 * k, seed, (False,) + tuple(args)))
+        tasks.append((run_replication, 2 * k + 1, seed, (True,) + tuple(args)))
+    results = run_tasks(tasks, workers, cache)
+    return results[0::2], results[1::2]
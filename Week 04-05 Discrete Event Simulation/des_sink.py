@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Chunked Parquet / Arrow export of entity tallies
+
+For very long runs the entity objects (customers, calls, toys) and the one
+big DataFrame built at the end no longer fit in memory.  A RecordSink writes
+the tally rows of finished entities to disk in fixed-size chunks while the
+simulation runs, one file per scenario and replication:
+
+    directory/scenario=<name>/replication=<i>/part-0.parquet
+
+The files can be scanned lazily afterwards (open_records), or read with only
+the columns and partitions needed (read_records), without re-simulating.
+
+Installation:   pip install pyarrow
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import os
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+#####################################################
+# Classes
+
+class RecordSink(object):
+    """Writes tally rows to one Parquet (or Arrow IPC) file in chunks
+       directory = root directory of the export
+       columns = column names, in the order of the tally rows
+       partition = dict of partition name -> value (scenario, replication)
+       chunk_rows = rows buffered before a chunk (row group) is written
+       file_format = 'parquet' or 'arrow'
+       types = dict of column name -> arrow type name ('string', 'int64',
+               'bool', ...) for the columns that are not float64
+       The schema is fixed up front from the columns and types, so every chunk
+       and an empty file have the same column types whatever values they hold
+       (a column that is all None in a chunk is still a string column)"""
+    def __init__(self, directory, columns, partition, chunk_rows=65536,
+                 file_format='parquet', types=None):
+        self.columns = list(columns)
+        self.chunk_rows = chunk_rows
+        self.file_format = file_format
+        self.rows = []
+        self.rows_written = 0
+        types = types or {}
+        self.schema = pa.schema([(name, pa.type_for_alias(types.get(name, 'float64')))
+                                 for name in self.columns])
+        self.writer = None
+        self.drain_at = chunk_rows
+
+        folder = os.path.join(directory, *['%s=%s' % (k, v) for k, v in partition.items()])
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, 'part-0.' + file_format)
+
+    def _table(self, rows):
+        arrays = [pa.array(column, type=field.type)
+                  for column, field in zip(zip(*rows), self.schema)]
+        return pa.Table.from_arrays(arrays, schema=self.schema)
+
+    def flush(self):
+        """Writes the buffered rows as one chunk"""
+        if not self.rows:
+            return
+        table = self._table(self.rows)
+        if self.writer is None:
+            if self.file_format == 'parquet':
+                self.writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = ipc.new_file(self.path, self.schema)
+        self.writer.write_table(table)
+        self.rows_written += len(self.rows)
+        self.rows = []
+
+    def write(self, rows):
+        """Buffers tally rows, writing a chunk every chunk_rows rows"""
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.chunk_rows:
+                self.flush()
+
+    def collect(self, entities, finished):
+        """Moves the finished entities of a list to the sink
+           entities = list of entities with getTallies(), changed in place
+           finished = function(entity) -> True once its tallies are final
+           Only scans the list once it has grown by chunk_rows since the last
+           scan, so it can be called on every arrival"""
+        if len(entities) < self.drain_at:
+            return
+        self.write(x.getTallies() for x in entities if finished(x))
+        entities[:] = [x for x in entities if not finished(x)]
+        self.drain_at = len(entities) + self.chunk_rows
+
+    def close(self):
+        """Writes the last chunk and closes the file
+           returns the file path (a file is written even if there are no rows)"""
+        self.flush()
+        if self.writer is None:
+            empty = self.schema.empty_table()
+            if self.file_format == 'parquet':
+                pq.write_table(empty, self.path)
+            else:
+                with ipc.new_file(self.path, empty.schema) as writer:
+                    writer.write_table(empty)
+        else:
+            self.writer.close()
+            self.writer = None
+        return self.path
+
+############################################################
+# Functions
+
+def open_records(path, file_format='parquet'):
+    """Lazy pyarrow Dataset over an export directory (or a single file)
+       The partition values are added as the columns scenario and replication"""
+    return ds.dataset(path, format='ipc' if file_format == 'arrow' else 'parquet',
+                      partitioning='hive')
+
+def read_records(path, columns=None, file_format='parquet', **partition):
+    """Reads an export into a pandas DataFrame
+       columns = columns to read, all by default
+       partition = partition values to keep, e.g. scenario='Base', replication=[0, 1]
+       Only the matching files are read"""
+    dataset = open_records(path, file_format)
+    condition = None
+    for name, value in partition.items():
+        if isinstance(value, (list, tuple)):
+            field = ds.field(name).isin(value)
+        else:
+            field = ds.field(name) == value
+        condition = field if condition is None else condition & field
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
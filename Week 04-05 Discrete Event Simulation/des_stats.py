@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Output analysis for the SimPy models
+
+Confidence intervals for replication results.  Every replication is treated
+as one independent observation of each KPI (for example the mean Total Time
+of segment A in that replication).
+
+For a single long run, BatchMeansTally finds the warm-up with MSER-5 and
+builds confidence intervals from non-overlapping batch means.  Across
+replications, the warm-up can be read from Welch's moving average of the
+ensemble mean curve, or picked automatically by MSER on the same curve.
+
+StreamingTally keeps running moments, min/max and a merging quantile digest,
+so memory does not grow with the length of the run.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import math
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+############################################################
+# Functions
+
+def confidence_interval(values, confidence=0.95):
+    """Mean and half-width of a t confidence interval
+       values = one observation per replication (NaN values are ignored)
+       returns (mean, half_width), half_width is inf with fewer than 2 values"""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    if n == 0:
+        return math.nan, math.inf
+    mean = values.mean()
+    if n < 2:
+        return mean, math.inf
+    t_value = stats.t.ppf((1.0 + confidence) / 2.0, n - 1)
+    return mean, t_value * values.std(ddof=1) / math.sqrt(n)
+
+def kpi_confidence_intervals(kpis, confidence=0.95):
+    """Confidence interval for every KPI
+       kpis = list with one dict of KPI name -> value per replication
+       returns a DataFrame indexed by KPI name"""
+    kpi_df = pd.DataFrame(list(kpis))
+    rows = []
+    for kpi in kpi_df.columns:
+        mean, half_width = confidence_interval(kpi_df[kpi].values, confidence)
+        rows.append([kpi, mean, half_width, mean - half_width, mean + half_width,
+                     kpi_df[kpi].count()])
+
+    return pd.DataFrame(rows, columns=['KPI','Mean','Half Width','Lower','Upper',
+                                       'Replications']).set_index('KPI')
+
+def paired_difference(kpis_a, kpis_b, confidence=0.95):
+    """Paired-t confidence interval of the KPI differences B - A
+       kpis_a, kpis_b = list with one dict of KPI name -> value per replication,
+                        replication i of A and B must share the same seed
+       Half Width (indep.) is what the interval would be without the pairing"""
+    a_df = pd.DataFrame(list(kpis_a))
+    b_df = pd.DataFrame(list(kpis_b))
+    n = min(len(a_df), len(b_df))
+    rows = []
+    for kpi in a_df.columns.intersection(b_df.columns):
+        a = a_df[kpi].values[:n].astype(float)
+        b = b_df[kpi].values[:n].astype(float)
+        difference, half_width = confidence_interval(b - a, confidence)
+        
+        t_value = stats.t.ppf((1.0 + confidence) / 2.0, max(n - 1, 1))
+        half_width_independent = t_value * math.sqrt((np.nanvar(a, ddof=1) + 
+                                                      np.nanvar(b, ddof=1)) / n)
+        rows.append([kpi, np.nanmean(a), np.nanmean(b), difference, half_width,
+                     difference - half_width, difference + half_width,
+                     half_width_independent, n])
+
+    result = pd.DataFrame(rows, columns=['KPI','Mean A','Mean B','Difference (B-A)',
+                                         'Half Width','Lower','Upper',
+                                         'Half Width (indep.)','Replications']).set_index('KPI')
+    result['Significant'] = (result['Lower'] > 0) | (result['Upper'] < 0)
+    return result
+
+def antithetic_summary(kpis_primary, kpis_antithetic, confidence=0.95):
+    """Confidence intervals from antithetic pairs and the variance reduction
+       kpis_primary, kpis_antithetic = one dict of KPI name -> value per run,
+                                       pair k is (kpis_primary[k], kpis_antithetic[k])
+       VRF = variance of the mean of 2n independent runs / variance of the mean
+       of n antithetic pairs = 1 / (1 + correlation within the pairs)
+       (correlation and VRF are NaN below 3 pairs, 2 pairs always give +-1)"""
+    a_df = pd.DataFrame(list(kpis_primary))
+    b_df = pd.DataFrame(list(kpis_antithetic))
+    rows = []
+    for kpi in a_df.columns.intersection(b_df.columns):
+        a = a_df[kpi].values.astype(float)
+        b = b_df[kpi].values.astype(float)
+        pair_means = (a + b) / 2.0
+        n = len(pair_means)
+        mean, half_width = confidence_interval(pair_means, confidence)
+        
+        # Independent runs: same marginal variance, no pairing
+        variance_independent = np.var(np.concatenate([a, b]), ddof=1) / 2.0
+        variance_pairs = np.var(pair_means, ddof=1)
+        if n < 3:
+            correlation = vrf = math.nan
+        else:
+            correlation = np.corrcoef(a, b)[0, 1]
+            vrf = variance_independent / variance_pairs if variance_pairs > 0 else math.inf
+        
+        t_value = stats.t.ppf((1.0 + confidence) / 2.0, max(2 * n - 1, 1))
+        half_width_independent = t_value * math.sqrt(variance_independent / n)
+        rows.append([kpi, mean, half_width, half_width_independent, correlation, vrf, n])
+
+    return pd.DataFrame(rows, columns=['KPI','Mean','Half Width','Half Width (indep.)',
+                                       'Correlation','VRF','Pairs']).set_index('KPI')
+
+def mser_truncation(values):
+    """MSER truncation point of an output series
+       values = series in time order (MSER-5 when these are means of 5 observations)
+       returns d, the number of leading values to delete, which minimizes
+       the variance of the remaining values / (n - d), over d <= n / 2"""
+    y = np.asarray(values, dtype=float)
+    n = len(y)
+    if n < 4:
+        return 0
+    # Sums over y[d:] for every d, from the back of the series
+    tail_sum = np.cumsum(y[::-1])[::-1]
+    tail_sum_sq = np.cumsum((y * y)[::-1])[::-1]
+    remaining = n - np.arange(n)
+    variance = tail_sum_sq / remaining - (tail_sum / remaining) ** 2
+    statistic = variance / remaining
+    return int(np.argmin(statistic[:n // 2 + 1]))
+
+def batch_means_interval(values, batches=20, confidence=0.95):
+    """Mean and half-width from non-overlapping batch means of one run
+       values = (warm-up free) series in time order
+       batches = number of batches, the tail that does not fill a batch is dropped"""
+    y = np.asarray(values, dtype=float)
+    batch_size = len(y) // batches
+    if batch_size == 0:
+        return (y.mean() if len(y) else math.nan), math.inf
+    batch_means = y[:batch_size * batches].reshape(batches, batch_size).mean(axis=1)
+    return confidence_interval(batch_means, confidence)
+
+def welch_moving_average(curve, window):
+    """Welch's moving average of a cross-replication mean curve
+       curve = mean over the replications at each time point
+       window = points on each side, the window shrinks near the start
+       returns len(curve) - window smoothed points"""
+    y = np.asarray(curve, dtype=float)
+    smoothed = np.empty(max(len(y) - window, 0))
+    for i in range(len(smoothed)):
+        w = min(i, window)
+        smoothed[i] = np.nanmean(y[i - w:i + w + 1])
+    return smoothed
+
+def ensemble_mean(values):
+    """Mean over the replications (rows) at every time point (columns)
+       points without data in any replication are NaN"""
+    values = np.asarray(values, dtype=float)
+    counts = np.sum(~np.isnan(values), axis=0)
+    sums = np.nansum(values, axis=0)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+############################################################
+# Classes
+
+class BatchMeansTally(object):
+    """Steady-state tally for one long run
+       kpis = names of the values recorded for every entity
+       batch_size = observations averaged together on record (5 for MSER-5)
+       warm_up_time = entities starting at or before this time are discarded
+                      when they are recorded, 0 to rely on MSER only
+       Only one mean per batch_size entities is kept, never the entities."""
+    def __init__(self, kpis, batch_size=5, warm_up_time=0):
+        self.kpis = list(kpis)
+        self.batch_size = batch_size
+        self.warm_up_time = warm_up_time
+        self.discarded = 0
+        self.sums = [0.0] * len(self.kpis)
+        self.count = 0
+        self.batch_start = 0.0
+        self.means = np.empty((1024, len(self.kpis)))
+        self.starts = np.empty(1024)
+        self.n = 0
+
+    def record(self, start_time, values):
+        if start_time <= self.warm_up_time:
+            self.discarded += 1
+            return
+        if self.count == 0:
+            self.batch_start = start_time
+        sums = self.sums
+        for j, value in enumerate(values):
+            sums[j] += value
+        self.count += 1
+        
+        if self.count == self.batch_size:
+            if self.n == len(self.starts):
+                # Grow the buffers by doubling
+                self.means = np.concatenate([self.means, np.empty_like(self.means)])
+                self.starts = np.concatenate([self.starts, np.empty_like(self.starts)])
+            self.means[self.n] = sums
+            self.starts[self.n] = self.batch_start
+            self.n += 1
+            self.sums = [0.0] * len(self.kpis)
+            self.count = 0
+
+    def results(self, batches=20, confidence=0.95):
+        """MSER-5 truncation (the largest over the KPIs) and batch-means intervals
+           returns (DataFrame of KPI intervals, dict describing the warm-up)"""
+        means = self.means[:self.n] / self.batch_size
+        d = max((mser_truncation(means[:, j]) for j in range(len(self.kpis))), default=0)
+        
+        rows = []
+        for j, kpi in enumerate(self.kpis):
+            mean, half_width = batch_means_interval(means[d:, j], batches, confidence)
+            rows.append([kpi, mean, half_width, mean - half_width, mean + half_width])
+        table = pd.DataFrame(rows, columns=['KPI','Mean','Half Width',
+                                            'Lower','Upper']).set_index('KPI')
+        
+        warm_up = {'Discarded on record': self.discarded,
+                   'Truncated by MSER': d * self.batch_size,
+                   'Warm-up ends': self.starts[d] if 0 < d < self.n else self.warm_up_time,
+                   'Observations used': (self.n - d) * self.batch_size,
+                   'Batches': batches}
+        return table, warm_up
+
+class QuantileDigest(object):
+    """Merging digest of a distribution for approximate quantiles (t-digest style)
+       compression = bound on the number of centroids kept
+       Centroids are finer in the tails, so high percentiles stay accurate."""
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+
+    def add(self, values):
+        """Adds a block of observations"""
+        values = np.asarray(values, dtype=float)
+        self._compress(np.concatenate([self.means, values]),
+                       np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other):
+        self._compress(np.concatenate([self.means, other.means]),
+                       np.concatenate([self.weights, other.weights]))
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        # Centroids sharing a cell of the arcsine scale are merged
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        cell = np.floor(self.compression * (np.arcsin(2 * q - 1) / np.pi + 0.5))
+        starts = np.flatnonzero(np.r_[True, cell[1:] != cell[:-1]])
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def quantile(self, p, minimum=None, maximum=None):
+        """Interpolated quantile, minimum/maximum pin the ends of the curve"""
+        if len(self.means) == 0:
+            return math.nan
+        cumulative = np.cumsum(self.weights)
+        q = (cumulative - self.weights / 2) / cumulative[-1]
+        low = self.means[0] if minimum is None else minimum
+        high = self.means[-1] if maximum is None else maximum
+        return float(np.interp(p, np.r_[0.0, q, 1.0], np.r_[low, self.means, high]))
+
+class StreamingStats(object):
+    """Running count, mean, variance, min, max and quantile digest of one KPI
+       Updated with blocks of observations (pairwise moment merge)"""
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.digest = QuantileDigest()
+
+    def add(self, values):
+        """Adds a block of observations"""
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        self.merge_moments(len(values), values.mean(), ((values - values.mean()) ** 2).sum(),
+                           values.min(), values.max())
+        self.digest.add(values)
+
+    def merge_moments(self, n, mean, m2, minimum, maximum):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.n * n / total
+        self.n = total
+        self.min = min(self.min, minimum)
+        self.max = max(self.max, maximum)
+
+    def merge(self, other):
+        if other.n:
+            self.merge_moments(other.n, other.mean, other.m2, other.min, other.max)
+            self.digest.merge(other.digest)
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else math.nan
+
+    def quantile(self, p):
+        return self.digest.quantile(p, self.min, self.max)
+
+class StreamingTally(object):
+    """Constant-memory tally, one StreamingStats per column
+       columns = names of the values recorded for every entity
+       block = records buffered before the statistics are updated"""
+    def __init__(self, columns, block=4096):
+        self.columns = list(columns)
+        self.stats = [StreamingStats() for _ in self.columns]
+        self.block = block
+        self.buffer = []
+
+    def __len__(self):
+        return self.stats[0].n + len(self.buffer) if self.stats else 0
+
+    def record(self, *values):
+        """Records one finished entity, values in the order of columns"""
+        self.buffer.append(values)
+        if len(self.buffer) >= self.block:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            block = np.array(self.buffer, dtype=float)
+            for j, stat in enumerate(self.stats):
+                stat.add(block[:, j])
+            self.buffer = []
+
+    def mean(self):
+        self.flush()
+        return {column: stat.mean for column, stat in zip(self.columns, self.stats)}
+
+def combine_streaming_tallies(tallies, quantiles=(0.5, 0.9, 0.95, 0.99)):
+    """Summary of several StreamingTally (e.g. replications) as a DataFrame
+       Count, mean, std, min and max are exact, the quantiles come from the
+       merged digests"""
+    tallies = list(tallies)
+    rows = []
+    for j, column in enumerate(tallies[0].columns):
+        combined = StreamingStats()
+        for tally in tallies:
+            tally.flush()
+            combined.merge(tally.stats[j])
+        std = math.sqrt(combined.variance()) if combined.n > 1 else math.nan
+        rows.append([column, combined.n, combined.mean, std, combined.min] + 
+                    [combined.quantile(p) for p in quantiles] + [combined.max])
+
+    quantile_columns = ['P%g' % (p * 100) for p in quantiles]
+    return pd.DataFrame(rows, columns=['KPI','Count','Mean','Std','Min'] + 
+                        quantile_columns + ['Max']).set_index('KPI')
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: SQLite experiment store for the SimPy models
+
+Keeps the results of every run in a local SQLite file, so scenarios can be
+compared later with a query instead of re-running the simulation.
+
+    runs             one row per run: model, run parameters, problem
+                     constants, seed and a hash of the model source
+    replication_kpis one row per run, scenario, replication and KPI
+    summary_kpis     one row per run, scenario and KPI (mean, half width)
+
+Rows are written with executemany in one transaction per call, and the KPI
+tables are indexed by scenario and replication.
+
+Usage from a model script:
+
+    store = ExperimentStore(EXPERIMENT_DB)
+    run_id = store.start_run(run_params.problem_name, run_params, globals())
+    store.add_replications(run_id, 'Base', [replication_kpis(r) for r in results])
+    store.add_summary(run_id, 'Base', kpi_results)
+    store.close()
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import dataclasses
+import hashlib
+import json
+import math
+import sqlite3
+from datetime import datetime
+import pandas as pd
+
+#####################################################
+# Tables
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    model          TEXT NOT NULL,
+    created        TEXT NOT NULL,
+    random_seed    INTEGER,
+    replications   INTEGER,
+    run_parameters TEXT,
+    constants      TEXT,
+    code_hash      TEXT
+);
+CREATE TABLE IF NOT EXISTS replication_kpis (
+    run_id      INTEGER NOT NULL REFERENCES runs(run_id),
+    scenario    TEXT NOT NULL,
+    replication INTEGER NOT NULL,
+    kpi         TEXT NOT NULL,
+    value       REAL
+);
+CREATE TABLE IF NOT EXISTS summary_kpis (
+    run_id       INTEGER NOT NULL REFERENCES runs(run_id),
+    scenario     TEXT NOT NULL,
+    kpi          TEXT NOT NULL,
+    value        REAL,
+    half_width   REAL,
+    replications INTEGER
+);
+CREATE INDEX IF NOT EXISTS replication_kpis_scenario
+    ON replication_kpis (scenario, replication, kpi);
+CREATE INDEX IF NOT EXISTS replication_kpis_run
+    ON replication_kpis (run_id, scenario);
+CREATE INDEX IF NOT EXISTS summary_kpis_scenario
+    ON summary_kpis (scenario, kpi);
+CREATE INDEX IF NOT EXISTS summary_kpis_run
+    ON summary_kpis (run_id, scenario);
+"""
+
+#####################################################
+# Classes
+
+class ExperimentStore(object):
+    """Experiment results in a SQLite file
+       path = database file, created with the tables if missing"""
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def start_run(self, model, run_params, namespace=None, code_path=None):
+        """Records the metadata of a run
+           model = model name (run_params.problem_name)
+           run_params = RunParameters of the run
+           namespace = module globals, the UPPER_CASE problem constants are kept
+           code_path = model source to hash, namespace['__file__'] by default
+           returns the run_id"""
+        namespace = namespace or {}
+        code_path = code_path or namespace.get('__file__')
+        row = (model, datetime.now().isoformat(timespec='seconds'),
+               run_params.random_seed, run_params.replications,
+               json.dumps(dataclasses.asdict(run_params), default=str),
+               json.dumps(problem_constants(namespace), default=str),
+               code_hash(code_path) if code_path else None)
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (model, created, random_seed, replications, '
+                'run_parameters, constants, code_hash) VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+        return cursor.lastrowid
+
+    def add_replications(self, run_id, scenario, kpis):
+        """Records the KPIs of every replication in one transaction
+           kpis = list (replication order) of dicts of KPI -> value"""
+        rows = [(run_id, scenario, replication, kpi, _real(value))
+                for replication, replication_kpis in enumerate(kpis)
+                for kpi, value in replication_kpis.items()]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO replication_kpis (run_id, scenario, replication, kpi, value) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def add_summary(self, run_id, scenario, summary):
+        """Records summary KPIs in one transaction
+           summary = dict of KPI -> value, or a confidence interval table
+                     (index KPI, columns Mean, Half Width and Replications)"""
+        if isinstance(summary, pd.DataFrame):
+            rows = [(run_id, scenario, str(kpi), _real(row['Mean']),
+                     _real(row.get('Half Width')), _int(row.get('Replications')))
+                    for kpi, row in summary.iterrows()]
+        else:
+            rows = [(run_id, scenario, kpi, _real(value), None, None)
+                    for kpi, value in summary.items()]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO summary_kpis (run_id, scenario, kpi, value, half_width, replications) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def query(self, sql, params=()):
+        """Any SELECT as a DataFrame"""
+        return pd.read_sql_query(sql, self.connection, params=params)
+
+    def replication_kpis(self, model=None, scenario=None, kpi=None):
+        """Replication KPIs of every run, optionally filtered, one column per KPI"""
+        sql = ('SELECT r.run_id, r.model, k.scenario, k.replication, k.kpi, k.value '
+               'FROM replication_kpis k JOIN runs r ON r.run_id = k.run_id WHERE 1 = 1')
+        params = []
+        for column, value in (('r.model', model), ('k.scenario', scenario), ('k.kpi', kpi)):
+            if value is not None:
+                sql += ' AND %s = ?' % column
+                params.append(value)
+        df = self.query(sql, params)
+        return df.pivot_table(index=['run_id','model','scenario','replication'],
+                              columns='kpi', values='value').reset_index()
+
+    def summary_kpis(self, model=None, scenario=None):
+        """Summary KPIs of every run, optionally filtered"""
+        sql = ('SELECT r.run_id, r.model, r.created, s.scenario, s.kpi, s.value, '
+               's.half_width, s.replications FROM summary_kpis s '
+               'JOIN runs r ON r.run_id = s.run_id WHERE 1 = 1')
+        params = []
+        for column, value in (('r.model', model), ('s.scenario', scenario)):
+            if value is not None:
+                sql += ' AND %s = ?' % column
+                params.append(value)
+        return self.query(sql, params)
+
+    def close(self):
+        self.connection.close()
+
+############################################################
+# Functions
+
+def _real(value):
+    if value is None:
+        return None
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+def _int(value):
+    return None if value is None else int(value)
+
+def problem_constants(namespace):
+    """UPPER_CASE module constants that can be stored as JSON"""
+    constants = {}
+    for name, value in namespace.items():
+        if not name.isupper() or name.startswith('_'):
+            continue
+        if dataclasses.is_dataclass(value) and not isinstance(value, type):
+            value = dataclasses.asdict(value)
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        constants[name] = value
+    return constants
+
+def code_hash(path):
+    """SHA-256 of a source file, so results can be traced to the model version"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+MBA 705: Columnar tallies for the SimPy models
+
+Keeping every entity object alive until the end of a run, only to read its
+t_* attributes into a DataFrame, costs memory and a slow list-to-DataFrame
+pass.  A Tally keeps one growable NumPy buffer per column instead.  Entities
+call record() when they finish and can then be discarded; the buffers are
+exported to a DataFrame without copying.
+
+@author: Chris Kennedy
+@license: MIT (https://en.wikipedia.org/wiki/MIT_License)
+
+"""
+
+#####################################################
+# Libraries
+
+import numpy as np
+import pandas as pd
+
+#####################################################
+# Classes
+
+class Tally(object):
+    """Columnar tally keyed by integer entity id
+       columns = names of the (float) values recorded for every entity
+       index_name = name of the entity id in the exported DataFrame
+       capacity = initial number of rows, doubled when full"""
+    def __init__(self, columns, index_name='Id', capacity=4096):
+        self.columns = list(columns)
+        self.index_name = index_name
+        # One contiguous row of the buffer per column
+        self.values = np.empty((len(self.columns), capacity))
+        self.ids = np.empty(capacity, dtype=np.int64)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self):
+        capacity = 2 * len(self.ids)
+        values = np.empty((len(self.columns), capacity))
+        values[:, :self.n] = self.values[:, :self.n]
+        ids = np.empty(capacity, dtype=np.int64)
+        ids[:self.n] = self.ids[:self.n]
+        self.values, self.ids = values, ids
+
+    def record(self, entity_id, *values):
+        """Records one finished entity, values in the order of columns"""
+        if self.n == len(self.ids):
+            self._grow()
+        self.ids[self.n] = entity_id
+        self.values[:, self.n] = values
+        self.n += 1
+
+    def column(self, name):
+        """View of one column (no copy)"""
+        return self.values[self.columns.index(name), :self.n]
+
+    def to_dataframe(self):
+        """DataFrame view of the recorded rows, indexed by entity id
+           The frame shares the buffers, so it reflects later record() calls
+           until the buffers grow; copy() it to keep a snapshot"""
+        index = pd.Index(self.ids[:self.n], name=self.index_name, copy=False)
+        return pd.DataFrame(self.values[:, :self.n].T, index=index,
+                            columns=self.columns, copy=False)
@@ -31,12 +31,16 @@ to abandon the call if they wait too long.
 # Libraries
 
 import simpy
-import random
-import numpy as np
 import pandas as pd
 from dataclasses import dataclass
 from enum import Enum
 from datetime import datetime
+from des_runner import run_replications, run_sequential, run_sweep
+from des_stats import kpi_confidence_intervals, paired_difference
+from des_random import RandomStreams, alias_transform, exponential_transform
+from des_sink import RecordSink, read_records
+from des_store import ExperimentStore
+from des_cache import ResultCache
 
 #####################################################
 # Classes
@@ -62,6 +66,7 @@ class RunParameters:
     author: str = "author"
     date_time: datetime = datetime.now()
     print_data: bool = False
+    workers: int = 1            # processes for replications, None = all cores
 
 # TODO
 # I need to figure out how to make these more like a data structure (attributes not vars)
@@ -74,18 +79,21 @@ class RunParameters:
 #    total_time: float
 
 class Customer(object):
-    def __init__(self, env, c_name, c_segment, c_paperwork, c_rtt, dmv_setup):
+    def __init__(self, env, c_name, c_segment, c_paperwork, c_rtt, c_draws, dmv_setup):
         self.env = env
         self.name = c_name
         self.segment = c_segment
         self.paperwork = c_paperwork
-        self.has_paperwork = np.random.random()
+        # Random draws are made on arrival from dedicated streams (see customer_source)
+        self.has_paperwork, self.e_paperwork, self.e_roadtest = c_draws
         self.roadtesttime = c_rtt
         self.t_start_time = env.now
         self.t_wait_time = 0
         self.t_work_time = 0
         self.t_paperwork = 0
         self.t_roadtest = 0
+        self.t_stop_time = 0
+        self.t_total_time = 0
         self.active = 1
         self.paperwork_time = 10
         self.abandon = 0
@@ -93,11 +101,13 @@ class Customer(object):
         self.action = env.process(self.enter_dmv(dmv_setup))
             
     def get_paperwork_time(self):
-        result = random.expovariate(1.0 / self.paperwork_time)
+        # Exponential with mean paperwork_time (scaled unit exponential)
+        result = self.paperwork_time * self.e_paperwork
         return result
     
     def get_roadtest_time(self):
-        result = random.expovariate(1.0 / self.roadtesttime)
+        # Exponential with mean roadtesttime (scaled unit exponential)
+        result = self.roadtesttime * self.e_roadtest
         return result
 
     def enter_dmv(self, dmv_setup):
@@ -137,26 +147,54 @@ class Customer(object):
             self.t_wait_time = self.t_total_time - self.t_work_time    
 
             # Customer completed DMV trip at this point
+
+    def getTallies(self):
+        return [self.name, self.segment, self.t_start_time, self.t_wait_time, 
+                self.t_work_time, self.t_stop_time, self.t_total_time, 
+                self.active, self.abandon]
             
 ############################################################
 # Functions        
 
-def customer_source(env, arrival_interval, dmv, attributes):
+def customer_source(env, arrival_interval, dmv, segments, streams):
     """Source generates customers randomly
        env = simpy Environment
        interval = arrival lambda for exponential distribution
-       dmv = resource(s) required"""
+       dmv = resource(s) required
+       segments = compiled segment attributes (see compile_segments)
+       streams = RandomStreams with one stream per random source (STREAM_NAMES)
+       Every customer takes exactly one draw from each stream on arrival, so 
+       customer i sees the same numbers in every scenario run with the same seed.
+       The draws are generated in blocks (VariateTape), segments as integer codes."""
+    tapes = {'Arrivals': streams.tape('Arrivals', exponential_transform(arrival_interval)),
+             'Segment': streams.tape('Segment', alias_transform(range(len(segments['names'])),
+                                                                segments['weights'])),
+             'Has Paperwork': streams.tape('Has Paperwork', lambda u: u),
+             'Paperwork Time': streams.tape('Paperwork Time', exponential_transform(1.0)),
+             'Road Test Time': streams.tape('Road Test Time', exponential_transform(1.0))}
+    names, paperwork, road_test_time = (segments['names'], segments['paperwork'],
+                                        segments['road_test_time'])
     i = 0
     while True:
         i+= 1
-        t = random.expovariate(1.0 / arrival_interval)
+        t = tapes['Arrivals'].draw()
         yield env.timeout(t)
         c_name = 'Customer%000006d' % i
-
-        c_segment = np.random.choice(attributes['Segments'],1,p=attributes['Segment %'])[0]
-        c_paperwork = attributes[attributes['Segments'] == c_segment]['Paperwork'].values[0]
-        c_roadtest  = attributes[attributes['Segments'] == c_segment]['RoadTestTime'].values[0]
-        customer_list.append(Customer(env, c_name, c_segment, c_paperwork, c_roadtest, dmv))
+        code = tapes['Segment'].draw()
+        c_segment = names[code]
+        c_paperwork = paperwork[code]
+        c_roadtest  = road_test_time[code]
+        c_draws = (tapes['Has Paperwork'].draw(),
+                   tapes['Paperwork Time'].draw(),
+                   tapes['Road Test Time'].draw())
+        customer_list.append(Customer(env, c_name, c_segment, c_paperwork, c_roadtest, c_draws, dmv))
+
+        # Move finished customers to disk so the list only holds customers in the DMV
+        if tally_sink is not None:
+            tally_sink.collect(customer_list, customer_finished)
+
+def customer_finished(customer):
+    return customer.active == 0
         
 # Could revoke the data class and add this as a method for run parameters class
 def printRunParameters(run_params):
@@ -170,7 +208,8 @@ def printRunParameters(run_params):
     print("Time Units: %s" % run_params.time_units)
     print("Author: %s" % run_params.author)
     print("DateTime: %s" % run_params.date_time)
-    print("Print Reults: %s" % run_params.print_data)        
+    print("Print Reults: %s" % run_params.print_data)
+    print("Workers: %s" % run_params.workers)
         
 ############################################################
 # Run parameters''
@@ -183,7 +222,8 @@ run_params = RunParameters(problem_name = 'DMV Split Road Test Time on Segments'
                            time_units   = TimeUnits.minutes,
                            author       = "Chris Kennedy",
                            date_time    = datetime.now(),
-                           print_data   = False)
+                           print_data   = False,
+                           workers      = None)
 
 ############################################################
 # Problem-specific parameters
@@ -199,65 +239,234 @@ SEGMENT_NAMES = ["A","B"]
 PAPERWORK = [0.95, 0.60]
 ROAD_TEST_TIME = [16.0, 8.0]
 
-attributes = pd.DataFrame({'Segments': SEGMENT_NAMES,
-                           'Segment %': SEGMENTS,
-                           'Paperwork': PAPERWORK,
-                           'RoadTestTime': ROAD_TEST_TIME})
+@dataclass(frozen=True)
+class Scenario:
+    name: str = run_params.problem_name
+    customer_rate: float = CUSTOMER_RATE
+    num_staff_clerks: int = NUM_STAFF_CLERKS
+    num_staff_roadtests: int = NUM_STAFF_ROADTESTS
+    segments: tuple = tuple(SEGMENTS)
+    paperwork: tuple = tuple(PAPERWORK)
+    road_test_time: tuple = tuple(ROAD_TEST_TIME)
+
+def scenario_attributes(scenario):
+    return pd.DataFrame({'Segments': SEGMENT_NAMES,
+                         'Segment %': list(scenario.segments),
+                         'Paperwork': list(scenario.paperwork),
+                         'RoadTestTime': list(scenario.road_test_time)})
+
+def compile_segments(attributes):
+    """Segment attributes as parallel lists indexed by integer segment code,
+       so an arrival looks its segment up without pandas"""
+    return {'names': list(attributes['Segments']),
+            'weights': list(attributes['Segment %']),
+            'paperwork': [float(x) for x in attributes['Paperwork']],
+            'road_test_time': [float(x) for x in attributes['RoadTestTime']]}
+
+attributes = scenario_attributes(Scenario())
+
+# Dedicated random number streams, one per random source (common random numbers)
+STREAM_NAMES = ['Arrivals','Segment','Has Paperwork','Paperwork Time','Road Test Time']
+
+# Comparison - set to a second Scenario to run it against this one with the
+# same seeds and print the paired differences, e.g.
+# COMPARE_SCENARIO = Scenario(name='DMV Base', road_test_time=(12.0, 12.0))
+COMPARE_SCENARIO = None
+
+# Precision - set TARGET_HALF_WIDTH to keep adding replications (beyond 
+# run_params.replications) until the confidence interval of every KPI in
+# TARGET_KPIS, for every segment, is at most this wide or MAX_REPLICATIONS is hit
+TARGET_HALF_WIDTH = None     # e.g. 0.05 (relative) or 2.0 minutes (absolute)
+TARGET_RELATIVE   = True     # half-width as a fraction of the mean
+TARGET_KPIS       = ['Total Time']
+CONFIDENCE        = 0.95
+MAX_REPLICATIONS  = 100
 
 ############################################################
 # Monitoring
 customer_list = []
+tally_sink = None
+
+TALLY_COLUMNS = ['Name','Segment','Start Time','Wait Time',
+                 'Process Time','Stop Time','Total Time',
+                 'Unfinished (WIP)','No paperwork']
+# Export types of the columns that are not float64
+TALLY_TYPES = {'Name': 'string', 'Segment': 'string',
+               'Unfinished (WIP)': 'int64', 'No paperwork': 'int64'}
+
+# Write the customer tallies to EXPORT_DIR in chunks while the model runs (None = keep in memory)
+EXPORT_DIR = None            # e.g. 'output/dmv'
+EXPORT_CHUNK_ROWS = 65536
+
+# Keep the replication and summary KPIs of every run in a SQLite file (None = off)
+EXPERIMENT_DB = None         # e.g. 'experiments.sqlite'
+
+# Read replications already simulated with the same model, constants and seed
+# from RESULT_CACHE_DIR instead of running them again (None = off).  Not used
+# with EXPORT_DIR, the cache keeps the tallies but not the export files.
+RESULT_CACHE_DIR = None      # e.g. 'cache/dmv'
+RESULT_CACHE_BYTES = 2**30   # least recently used results are evicted beyond this size
+# Constants that do not change a replication, only what is run or reported
+RESULT_CACHE_IGNORE = ['COMPARE_SCENARIO','TARGET_HALF_WIDTH','TARGET_RELATIVE','TARGET_KPIS',
+                       'CONFIDENCE','MAX_REPLICATIONS','EXPERIMENT_DB']
+result_cache = None
 
 ############################################################
 # Initialize and Run
 
-# I need both seeds since I'm using the NP Random choice function
-random.seed(run_params.random_seed)
-np.random.seed(run_params.random_seed)
+def run_replication(replication, seed, scenario=Scenario()):
+    """Runs one replication of the DMV
+       replication = replication index (0 based)
+       seed = seed for this replication only (see des_runner.replication_seed)
+       scenario = Scenario to run, the module constants by default
+       returns the customer tallies of the replication (the export file if EXPORT_DIR is set)"""
+    global customer_list, tally_sink
 
-for i in range(run_params.replications):
-    print("Starting replication...%06d" % (i+1))
-    env = simpy.Environment()
+    # One stream per random source instead of the global random / np.random
+    streams = RandomStreams(seed, STREAM_NAMES)
 
-    clerk = simpy.Resource(env, capacity = NUM_STAFF_CLERKS)
-    roadtest = simpy.Resource(env, capacity = NUM_STAFF_ROADTESTS)
+    print("Starting replication...%06d" % (replication+1))
+    env = simpy.Environment()
+    customer_list = []
+    if EXPORT_DIR is not None:
+        tally_sink = RecordSink(EXPORT_DIR, TALLY_COLUMNS,
+                                {'scenario': scenario.name, 'replication': replication},
+                                EXPORT_CHUNK_ROWS, types=TALLY_TYPES)
+
+    clerk = simpy.Resource(env, capacity = scenario.num_staff_clerks)
+    roadtest = simpy.Resource(env, capacity = scenario.num_staff_roadtests)
     dmv= {'Clerk': clerk, 
           'Roadtest': roadtest}
 
     # Run Sim.py
     
-    env.process(customer_source(env,CUSTOMER_RATE, dmv, attributes))
+    env.process(customer_source(env, scenario.customer_rate, dmv, 
+                                compile_segments(scenario_attributes(scenario)), streams))
     env.run(until=run_params.run_time)
 
-############################################################
-# Collect Results
-finished_list = []
-for i in customer_list:
-    if (i.active == 0 and i.abandon == 0 and i.t_start_time > run_params.warm_up_time):
-        finished_list.append(i)
-
-df = pd.DataFrame(([x.name, x.segment, x.t_start_time, x.t_wait_time, 
-                         x.t_work_time, x.t_stop_time, 
-                         x.t_total_time, x.active, x.abandon] for x in finished_list), 
-                        columns=['Name','Segment','Start Time','Wait Time',
-                                 'Process Time','Stop Time','Total Time',
-                                 'Unfinished (WIP)','No paperwork'])
-
-segment_results = df.groupby(by=['Segment']).mean()
+    # Customer objects hold the simpy environment, so only the tallies are returned
+    if tally_sink is not None:
+        tally_sink.write(x.getTallies() for x in customer_list)
+        path, tally_sink = tally_sink.close(), None
+        return path
+    return [x.getTallies() for x in customer_list]
+
+def finished_customers(customer_tally):
+    """Completed customers (with paperwork) that arrived after the warm-up
+       customer_tally = tally rows, a DataFrame or an export file"""
+    if isinstance(customer_tally, str):
+        customer_tally = read_records(customer_tally, TALLY_COLUMNS)
+    all_df = pd.DataFrame(customer_tally, columns=TALLY_COLUMNS)
+    return all_df[(all_df['Unfinished (WIP)'] == 0) & 
+                  (all_df['No paperwork'] == 0) & 
+                  (all_df['Start Time'] > run_params.warm_up_time)]
+
+def replication_kpis(customer_tally):
+    """Per segment means of the TARGET_KPIS for one replication"""
+    df = finished_customers(customer_tally)
+    segment_means = df.groupby(by=['Segment'])[TARGET_KPIS].mean()
+    return {'%s (%s)' % (kpi, segment): segment_means.loc[segment, kpi] 
+            for segment in segment_means.index for kpi in TARGET_KPIS}
+
+def compare_scenarios(scenario_a, scenario_b):
+    """Runs both scenarios with the same replication seeds
+       returns the paired differences (B - A) of the replication KPIs and the
+       replication KPIs of each scenario"""
+    results_a, results_b = run_sweep(run_replication, [(scenario_a,), (scenario_b,)],
+                                     run_params.replications, run_params.random_seed,
+                                     run_params.workers, cache=result_cache)
+    kpis_a = [replication_kpis(r) for r in results_a]
+    kpis_b = [replication_kpis(r) for r in results_b]
+    return paired_difference(kpis_a, kpis_b, CONFIDENCE), {scenario_a.name: kpis_a,
+                                                           scenario_b.name: kpis_b}
+
+def save_experiment(scenario_kpis, summaries=None):
+    """Writes a run to EXPERIMENT_DB
+       scenario_kpis = dict of scenario name -> list of replication KPIs
+       summaries = dict of scenario name -> confidence interval table,
+                   computed from the replication KPIs if missing"""
+    store = ExperimentStore(EXPERIMENT_DB)
+    run_id = store.start_run(run_params.problem_name, run_params, globals())
+    for scenario, kpis in scenario_kpis.items():
+        store.add_replications(run_id, scenario, kpis)
+        summary = (summaries or {}).get(scenario)
+        if summary is None:
+            summary = kpi_confidence_intervals(kpis, CONFIDENCE)
+        store.add_summary(run_id, scenario, summary)
+    store.close()
+    return run_id
+
+if __name__ == '__main__' and RESULT_CACHE_DIR is not None and EXPORT_DIR is None:
+    result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+
+if __name__ == '__main__' and COMPARE_SCENARIO is not None:
+    comparison, scenario_kpis = compare_scenarios(Scenario(), COMPARE_SCENARIO)
+    if EXPERIMENT_DB is not None:
+        save_experiment(scenario_kpis)
+
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)
+    print("")
+    print("A: %s" % Scenario())
+    print("B: %s" % COMPARE_SCENARIO)
+    print("")
+    print("%d%% Paired Confidence Intervals B - A (common random numbers):" % (CONFIDENCE * 100))
+    print(comparison.to_string())
+    print("\nProgram Complete - END")
+
+elif __name__ == '__main__':
+    if TARGET_HALF_WIDTH is None:
+        results = run_replications(run_replication, run_params.replications,
+                                   run_params.random_seed, run_params.workers,
+                                   cache=result_cache)
+        kpis = [replication_kpis(r) for r in results]
+        kpi_results = kpi_confidence_intervals(kpis, CONFIDENCE)
+    else:
+        results, kpi_results = run_sequential(run_replication, replication_kpis,
+                                              run_params.random_seed, TARGET_HALF_WIDTH,
+                                              relative=TARGET_RELATIVE,
+                                              confidence=CONFIDENCE,
+                                              min_replications=run_params.replications,
+                                              max_replications=MAX_REPLICATIONS,
+                                              workers=run_params.workers,
+                                              cache=result_cache)
+        kpis = [replication_kpis(r) for r in results]
+
+    if EXPERIMENT_DB is not None:
+        save_experiment({Scenario().name: kpis}, {Scenario().name: kpi_results})
+
+    ############################################################
+    # Collect Results
+    if EXPORT_DIR is not None:
+        customer_tally = read_records(EXPORT_DIR, TALLY_COLUMNS, scenario=Scenario().name,
+                                      replication=list(range(len(results))))
+    else:
+        customer_tally = [row for tally in results for row in tally]
+    df = finished_customers(customer_tally)
+
+    segment_results = df.groupby(by=['Segment']).mean(numeric_only=True)
     
-############################################################
-# printresults
-print("")
-print("Simulation complete")
-print("")
-printRunParameters(run_params)   
-print("")
-print("Customers:            %6d" % len(customer_list))
-print("Tallied Customers:    %6d" % len(finished_list))
-print("")
-print("Means for Data Tallies:")
-print(df.mean())
-print(segment_results[['Total Time','No paperwork']])
-############################################################
-# Finished
-print("\nProgram Complete - END")
+    ############################################################
+    # printresults
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)   
+    print("")
+    print("Replications run:     %6d" % len(results))
+    print("Customers:            %6d" % len(customer_tally))
+    print("Tallied Customers:    %6d" % len(df))
+    print("")
+    print("Means for Data Tallies:")
+    print(df.mean(numeric_only=True))
+    print(segment_results[['Total Time','No paperwork']])
+    print("")
+    print("%d%% Confidence Intervals by Segment (replication means):" % (CONFIDENCE * 100))
+    print(kpi_results.to_string())
+    if TARGET_HALF_WIDTH is not None and not kpi_results['Met'].all():
+        print("Target half-width not met after %d replications" % len(results))
+    ############################################################
+    # Finished
+    print("\nProgram Complete - END")
@@ -42,6 +42,13 @@ from enum import Enum
 from datetime import datetime
 import math
 import matplotlib.pyplot as plt
+import itertools
+from des_runner import run_replications, run_sweep as run_sweep_tasks
+from des_stats import welch_moving_average, ensemble_mean, mser_truncation
+from des_sink import RecordSink, read_records
+from des_store import ExperimentStore
+from des_queueing import jackson_network
+from des_cache import ResultCache, Checkpoint
 
 #####################################################
 # Classes
@@ -67,6 +74,7 @@ class RunParameters:
     author: str = "author"
     date_time: datetime = datetime.now()
     print_data: bool = False
+    workers: int = 1            # processes for replications, None = all cores
 
 # TODO
 # I need to figure out how to make these more like a data structure (attributes not vars)
@@ -86,6 +94,7 @@ class Toy(object):
         self.profit = toy['Profit']
         self.station_times = [toy['Station 1'], toy['Station 2'], toy['Station 3']]
         self.status = 'In Progress'
+        self.quality = toy['Quality']
         self.rework = 0
         self.replication = replication
         
@@ -130,7 +139,7 @@ class Toy(object):
             self.t_work_time += t_station_two
             
             # If Auto, check for rework
-            if self.type == 'Auto' and random.random() > AUTO_QUALITY:
+            if self.type == 'Auto' and random.random() > self.quality:
                 self.rework += 1
                 self.env.process(self.station_two(factory))
             else:
@@ -152,6 +161,11 @@ class Toy(object):
             self.t_stop_time = self.env.now
             self.t_total_time = self.t_stop_time - self.t_start_time
             self.status = 'Done'
+
+    def getTallies(self):
+        return [self.name, self.type, self.rework, self.profit, self.replication,
+                self.t_start_time, self.t_wait_time, self.t_work_time, self.t_stop_time,
+                self.t_total_time, self.status]
           
 ############################################################
 # Functions        
@@ -172,6 +186,20 @@ def toy_source(env, toy, factory, replication):
            
         # Create the customer in the simulation
         toy_list.append(Toy(env, toy_name, toy, factory, replication))
+
+        # Move finished toys to disk so the list only holds the WIP
+        if tally_sink is not None:
+            tally_sink.collect(toy_list, toy_finished)
+
+def toy_finished(toy):
+    return toy.status == 'Done'
+
+def wip_monitor(env, factory, wip_tally, interval):
+    """Samples the WIP (queue + in process) of every station each interval"""
+    while True:
+        wip_tally.append([env.now] + [len(factory[station].queue) + factory[station].count
+                                      for station in STATION_NAMES])
+        yield env.timeout(interval)
                              
 # Could revoke the data class and add this as a method for run parameters class
 def printRunParameters(run_params):
@@ -185,7 +213,8 @@ def printRunParameters(run_params):
     print("Time Units: %s" % run_params.time_units)
     print("Author: %s" % run_params.author)
     print("DateTime: %s" % run_params.date_time)
-    print("Print Results: %s" % run_params.print_data)        
+    print("Print Results: %s" % run_params.print_data)
+    print("Workers: %s" % run_params.workers)
         
 ############################################################
 # Run parameters''
@@ -198,7 +227,8 @@ run_params = RunParameters(problem_name = 'Kenan Toy Company Model',
                            time_units   = TimeUnits.days,
                            author       = "Chris Kennedy",
                            date_time    = datetime.now(),
-                           print_data   = False)
+                           print_data   = False,
+                           workers      = None)
 
 ############################################################
 # Problem Description
@@ -217,10 +247,18 @@ EXTRA_MACHINES_ONE     = 0
 EXTRA_MACHINES_TWO     = 0
 EXTRA_MACHINES_THREE   = 0
 
+# SWEEP - set to a grid of decisions to run every combination at once
+# instead of the single decision above, e.g.
+# SWEEP_GRID = {'num_auto_inc':         [0, 2, 4, 6],
+#               'extra_machines_one':   [0, 1],
+#               'extra_machines_two':   [0, 1],
+#               'extra_machines_three': [0, 1]}
+# or give SWEEP_DECISIONS as a list of Decisions(...) vectors
+SWEEP_GRID      = None
+SWEEP_DECISIONS = None
+
 # Resources
-STATION_ONE_MACHINES   = 2 + EXTRA_MACHINES_ONE
-STATION_TWO_MACHINES   = 2 + EXTRA_MACHINES_TWO
-STATION_THREE_MACHINES = 2 + EXTRA_MACHINES_THREE
+BASE_MACHINES = 2   # per station, plus the extra machines of Decisions
 
 # Auto Choices
 AUTO_5PCT          = 0.05
@@ -235,10 +273,12 @@ MKT_PROMISE = 3 # days
 # PRODUCT Details
 PRODUCT_RATES = [1.0, 1.0, 1.0]
 PRODUCT_NAMES = ["Plane","Train","Auto"]
-PRODUCT_GROSS_PROFITS = [500.00, 250.00, 500.00 - COST_AUTO_5PCT * NUM_AUTO_INC] # Base for Auto is $500 @ 70%
+# Base for Auto is $500 @ 70%
+PRODUCT_GROSS_PROFITS = [500.00, 250.00, 500.00 - COST_AUTO_5PCT * NUM_AUTO_INC]
 
 # Other factors
-AUTO_QUALITY = 0.70 + AUTO_5PCT * NUM_AUTO_INC
+AUTO_BASE_QUALITY = 0.70
+AUTO_QUALITY = AUTO_BASE_QUALITY + AUTO_5PCT * NUM_AUTO_INC
 
 # Times
 # Planes skip station 2
@@ -247,116 +287,492 @@ STATION_ONE_TIMES   =  [0.8,0.4,0.6]
 STATION_TWO_TIMES   =  [0.0,0.6,0.6]
 STATION_THREE_TIMES =  [0.8,0.1,0.4]
 
+STATION_NAMES = ['Station 1','Station 2','Station 3']
+
+# Warm-up - WARM_UP_ANALYSIS prints (and plots) Welch's moving average of the
+# cross-replication Total Time and station WIP curves with a recommended 
+# truncation point (MSER on the cross-replication mean of each curve),
+# AUTO_WARM_UP uses that point in place of run_params.warm_up_time 
+# (per decision vector in a sweep).  MSER searches the first half of a curve
+# only, a truncation point near that cap means no warm-up was found; past
+# MSER_LIMIT of a curve a warning is printed and run_params.warm_up_time is
+# used instead (marked in the warm-up report and the sweep table)
+WARM_UP_ANALYSIS = False
+AUTO_WARM_UP     = False
+WELCH_BIN        = 1         # days per point of the curves
+WELCH_WINDOW     = 10        # points on each side of the moving average
+MSER_LIMIT       = 1/3       # largest accepted truncation, fraction of a curve
+
+DECISION_COLUMNS = ['NUM_AUTO_INC','EXTRA_MACHINES_ONE',
+                    'EXTRA_MACHINES_TWO','EXTRA_MACHINES_THREE']
+
+@dataclass(frozen=True)
+class Decisions:
+    num_auto_inc: int = NUM_AUTO_INC
+    extra_machines_one: int = EXTRA_MACHINES_ONE
+    extra_machines_two: int = EXTRA_MACHINES_TWO
+    extra_machines_three: int = EXTRA_MACHINES_THREE
+
+    def as_list(self):
+        return [self.num_auto_inc, self.extra_machines_one,
+                self.extra_machines_two, self.extra_machines_three]
+
+    def label(self):
+        return '-'.join(str(x) for x in self.as_list())
+
+def sweep_decisions(grid):
+    """Every combination of a grid of decisions
+       grid = dict of Decisions field name -> list of values
+       missing fields keep the module default"""
+    names = list(grid.keys())
+    return [Decisions(**dict(zip(names, values))) 
+            for values in itertools.product(*(grid[name] for name in names))]
+
+def build_toy_attributes(decisions):
+    """Toy data (times, profit, arrival rate, quality) for a decision vector"""
+    auto_profit = 500.00 - COST_AUTO_5PCT * decisions.num_auto_inc
+    auto_quality = AUTO_BASE_QUALITY + AUTO_5PCT * decisions.num_auto_inc
+    gross_profits = [PRODUCT_GROSS_PROFITS[0], PRODUCT_GROSS_PROFITS[1], auto_profit]
+    
+    toy_attributes = []
+    for t in range(len(PRODUCT_NAMES)):
+        toy_attributes.append({'Station 1': STATION_ONE_TIMES[t],
+                               'Station 2': STATION_TWO_TIMES[t],
+                               'Station 3': STATION_THREE_TIMES[t],
+                               'Name': PRODUCT_NAMES[t],
+                               'Profit': gross_profits[t],
+                               'Arrival Rate': PRODUCT_RATES[t],
+                               'Quality': auto_quality if PRODUCT_NAMES[t] == 'Auto' else 1.0})
+    return toy_attributes
+
+def network_approximation(decision_list):
+    """Open network (Jackson) approximation of the factory for many decision
+       vectors in one vectorized call, e.g. network_approximation(sweep_decisions(grid))
+       returns one row per decision vector with the station utilization and
+       wait, the expected Total Time of every toy and the profit it implies
+       (as summarize_results computes it, -inf if a station is overloaded)"""
+    decision_array = np.array([d.as_list() for d in decision_list], dtype=float)
+    quality = np.minimum(AUTO_BASE_QUALITY + AUTO_5PCT * decision_array[:, 0], 1.0)
+
+    # Station 1 -> 2 -> 3, planes skip station 2 and autos go back to it
+    routing = np.zeros((len(decision_list), len(PRODUCT_NAMES), 3, 3))
+    for p, name in enumerate(PRODUCT_NAMES):
+        if name == 'Plane':
+            routing[:, p, 0, 2] = 1.0
+        else:
+            rework = 1.0 - quality if name == 'Auto' else 0.0
+            routing[:, p, 0, 1] = 1.0
+            routing[:, p, 1, 1] = rework
+            routing[:, p, 1, 2] = 1.0 - rework
+    service_means = np.array([STATION_ONE_TIMES, STATION_TWO_TIMES, STATION_THREE_TIMES]).T
+    servers = BASE_MACHINES + decision_array[:, 1:]
+    arrival_rates = 1.0 / np.array(PRODUCT_RATES)
+    network = jackson_network(arrival_rates, routing, service_means, servers)
+
+    df = pd.DataFrame(decision_array.astype(int), columns=DECISION_COLUMNS)
+    for s, station in enumerate(STATION_NAMES):
+        df['Utilization (%s)' % station] = network['Utilization'][:, s]
+        df['Wait (%s)' % station] = network['Wq'][:, s]
+    for p, name in enumerate(PRODUCT_NAMES):
+        df['Total Time (%s)' % name] = network['Flow Time'][:, p]
+    df['Stable'] = network['Stable'].all(axis=1)
+
+    profits = (np.array([PRODUCT_GROSS_PROFITS[0], PRODUCT_GROSS_PROFITS[1], 500.00]) *
+               np.ones_like(network['Flow Time']))
+    profits[:, PRODUCT_NAMES.index('Auto')] = 500.00 - COST_AUTO_5PCT * decision_array[:, 0]
+    active_time = run_params.run_time - run_params.warm_up_time
+    product_profit = (arrival_rates * profits).sum(axis=1) * active_time
+    marketing_penalty = np.maximum(network['Flow Time'] - MKT_PROMISE, 0).sum(axis=1) * COST_MKT
+    df['Profit'] = (product_profit - COST_MACHINE * decision_array[:, 1:].sum(axis=1) -
+                    marketing_penalty)
+    return df
+
+def print_network_check(decisions, summary):
+    """Analytic against simulated average Total Time by toy"""
+    network = network_approximation([decisions]).iloc[0]
+    check = pd.DataFrame({'Analytic': [network['Total Time (%s)' % name]
+                                       for name in PRODUCT_NAMES]},
+                         index=pd.Index(PRODUCT_NAMES, name='Type'))
+    check['Simulated'] = summary['average_times']['Total Time']
+    check['Difference %'] = 100 * (check['Simulated'] - check['Analytic']) / check['Analytic']
+    print("\nNetwork Check (open network approximation):")
+    print(check.to_string())
+    print("Station utilization: " +
+          ", ".join('%s %.3f' % (station, network['Utilization (%s)' % station])
+                    for station in STATION_NAMES))
+    print("Analytic profit:          ${:11.2f}".format(network['Profit']))
+
 
 ############################################################
 # Monitoring
 toy_list = []
+tally_sink = None
+
+TOY_COLUMNS = ['Name','Type','Rework (ST2)','Profit', ' Replication',
+               'Start Time','Wait Time','Process Time','Stop Time',
+               'Total Time','Status']
+# Export types of the columns that are not float64
+TOY_TYPES = {'Name': 'string', 'Type': 'string', 'Status': 'string',
+             'Rework (ST2)': 'int64', ' Replication': 'int64'}
+
+# Write the toy tallies to EXPORT_DIR in chunks while the model runs (None = keep
+# in memory), one partition per decision vector (Decisions.label) and replication
+EXPORT_DIR = None            # e.g. 'output/kenan'
+EXPORT_CHUNK_ROWS = 65536
+
+# Keep the replication and summary KPIs of every run in a SQLite file (None = off),
+# one scenario per decision vector (Decisions.label)
+EXPERIMENT_DB = None         # e.g. 'experiments.sqlite'
+
+# Read replications already simulated with the same model, constants, decisions
+# and seed from RESULT_CACHE_DIR instead of running them again (None = off), so
+# a sweep with a few new grid points only simulates the new points.  Not used
+# with EXPORT_DIR, the cache keeps the tallies but not the export files.
+RESULT_CACHE_DIR = None      # e.g. 'cache/kenan'
+RESULT_CACHE_BYTES = 2**30   # least recently used results are evicted beyond this size
+# Constants that do not change a replication, only what is run or reported
+RESULT_CACHE_IGNORE = ['SWEEP_GRID','SWEEP_DECISIONS','WARM_UP_ANALYSIS','AUTO_WARM_UP',
+                       'MSER_LIMIT','EXPERIMENT_DB','NETWORK_CHECK']
+result_cache = None
+
+# Checkpoint - save every replication to CHECKPOINT_DIR as soon as it finishes
+# (None = off).  After a crash, set RESUME = True and run again: the saved
+# replications are read back, the rest are simulated with their own seeds, and
+# the results are the same as those of an uninterrupted run.  RESUME = False
+# clears the checkpoint.  Takes the place of RESULT_CACHE_DIR when both are set.
+# Not used with EXPORT_DIR, a restored replication would not write its export file.
+CHECKPOINT_DIR = None        # e.g. 'checkpoints/kenan'
+RESUME = False
+
+# Open network approximation (des_queueing.jackson_network) of the decisions,
+# compared with the simulated Total Time (single decision) or added to the
+# sweep table as Analytic Profit, so a grid can be screened before simulating
+NETWORK_CHECK = False
 
 ############################################################
 # Initialize and Run
 
-# I need both seeds since I'm using the NP Random choice function
-random.seed(run_params.random_seed)
-np.random.seed(run_params.random_seed)
+def run_replication(replication, seed, decisions=Decisions()):
+    """Runs one replication of the factory for one decision vector
+       replication = replication index (0 based)
+       seed = seed for this replication only (see des_runner.replication_seed)
+       returns the toy tallies (the export file if EXPORT_DIR is set) and the 
+       station WIP samples of the replication"""
+    global toy_list, tally_sink
 
+    # I need both seeds since I'm using the NP Random choice function
+    random.seed(seed)
+    np.random.seed(seed)
 
-plane_data = {'Station 1': STATION_ONE_TIMES[0],
-                  'Station 2': STATION_TWO_TIMES[0],
-                  'Station 3': STATION_THREE_TIMES[0],
-                  'Name': PRODUCT_NAMES[0],
-                  'Profit': PRODUCT_GROSS_PROFITS[0],
-                  'Arrival Rate': PRODUCT_RATES[0]}
-    
-train_data = {'Station 1': STATION_ONE_TIMES[1],
-                  'Station 2': STATION_TWO_TIMES[1],
-                  'Station 3': STATION_THREE_TIMES[1],
-                  'Name': PRODUCT_NAMES[1],
-                  'Profit': PRODUCT_GROSS_PROFITS[1],
-                  'Arrival Rate': PRODUCT_RATES[1]}
-    
-auto_data  = {'Station 1': STATION_ONE_TIMES[2],
-                  'Station 2': STATION_TWO_TIMES[2],
-                  'Station 3': STATION_THREE_TIMES[2],
-                  'Name': PRODUCT_NAMES[2],
-                  'Profit': PRODUCT_GROSS_PROFITS[2],
-                  'Arrival Rate': PRODUCT_RATES[2]}
-
-toy_attributes = [plane_data, train_data, auto_data]
-
-print("Starting Model: ", run_params.problem_name)
-for i in range(run_params.replications):
-    print("Starting replication...%06d" % (i+1))
+    print("Starting replication...%06d" % (replication+1))
     env = simpy.Environment()
-
-    machine_a = simpy.Resource(env, capacity = STATION_ONE_MACHINES)
-    machine_b = simpy.Resource(env, capacity = STATION_TWO_MACHINES)
-    machine_c = simpy.Resource(env, capacity = STATION_THREE_MACHINES)
+    toy_list = []
+    if EXPORT_DIR is not None:
+        tally_sink = RecordSink(EXPORT_DIR, TOY_COLUMNS,
+                                {'scenario': decisions.label(), 'replication': replication},
+                                EXPORT_CHUNK_ROWS, types=TOY_TYPES)
+
+    machine_a = simpy.Resource(env, capacity = BASE_MACHINES + decisions.extra_machines_one)
+    machine_b = simpy.Resource(env, capacity = BASE_MACHINES + decisions.extra_machines_two)
+    machine_c = simpy.Resource(env, capacity = BASE_MACHINES + decisions.extra_machines_three)
       
     factory = {'Station 1': machine_a, 
                'Station 2': machine_b,
                'Station 3': machine_c}
     
     # Initialize toy sources
-    for toy in toy_attributes:
-        env.process(toy_source(env, toy, factory, i)) 
+    for toy in build_toy_attributes(decisions):
+        env.process(toy_source(env, toy, factory, replication)) 
+    
+    wip_tally = []
+    env.process(wip_monitor(env, factory, wip_tally, WELCH_BIN))
     
     # Run environment
     env.run(until=run_params.run_time)
+
+    # Toy objects hold the simpy environment, so only the tallies are returned
+    if tally_sink is not None:
+        tally_sink.write(x.getTallies() for x in toy_list)
+        path, tally_sink = tally_sink.close(), None
+        return path, wip_tally
+    return [x.getTallies() for x in toy_list], wip_tally
+
+def all_toy_tallies(results, decisions):
+    """Toy tallies of all replications of one decision vector
+       a DataFrame read back from EXPORT_DIR if set, otherwise a list of rows"""
+    if EXPORT_DIR is not None:
+        return read_records(EXPORT_DIR, TOY_COLUMNS, scenario=decisions.label(),
+                            replication=list(range(len(results))))
+    return [row for tally, _ in results for row in tally]
+
+def warm_up_analysis(results, label=None):
+    """Welch's procedure over the replications of one decision vector
+       results = run_replication results
+       label = name of the decision vector in the warning
+       returns the smoothed curves (one column per series), the truncation time
+       of every series, the series whose truncation is past MSER_LIMIT and the
+       recommended warm-up (the latest truncation, run_params.warm_up_time if
+       any series is past the limit)"""
+    n_points = int(run_params.run_time / WELCH_BIN)
+    total_time = np.full((len(results), n_points), np.nan)
+    wip = np.full((len(results), n_points, len(STATION_NAMES)), np.nan)
     
-############################################################
-# Collect & Process Results
-finished_list = []
-for i in toy_list:
-    if (i.status == 'Done' and i.t_start_time > run_params.warm_up_time):
-        finished_list.append(i)
-
-df = pd.DataFrame(([x.name, x.type, x.rework, x.profit, x.replication,
-                    x.t_start_time, x.t_wait_time, x.t_work_time, x.t_stop_time, 
-                    x.t_total_time] for x in finished_list), 
-                   columns=['Name','Type','Rework (ST2)','Profit', ' Replication',
-                            'Start Time','Wait Time','Process Time','Stop Time',
-                            'Total Time'])
-
-result_percent_exceeding_marketing_promise = df[df['Total Time'] > MKT_PROMISE]['Name'].count() / df['Name'].count()    
+    for r, (toy_tally, wip_tally) in enumerate(results):
+        # Mean Total Time of the finished toys by start time
+        if isinstance(toy_tally, str):
+            toys = read_records(toy_tally, ['Start Time','Total Time','Status'])
+            done = toys.loc[toys['Status'] == 'Done', ['Start Time','Total Time']].values
+        else:
+            done = [(row[5], row[9]) for row in toy_tally if row[10] == 'Done']
+        if len(done):
+            start, total = np.array(done).T
+            point = np.minimum((start / WELCH_BIN).astype(int), n_points - 1)
+            counts = np.bincount(point, minlength=n_points)
+            sums = np.bincount(point, weights=total, minlength=n_points)
+            with np.errstate(invalid='ignore'):
+                total_time[r] = sums / counts
+        samples = np.array(wip_tally)[:n_points, 1:]
+        wip[r, :len(samples)] = samples
     
-result_average_times = df[['Type','Total Time']].groupby(by=['Type']).mean()
-result_counts = df[['Name','Type']].groupby(by=['Type']).count()
+    series = {'Total Time': total_time}
+    for s, station in enumerate(STATION_NAMES):
+        series['WIP ' + station] = wip[:, :, s]
     
-result_product_profit = df['Profit'].sum() / run_params.replications
-
-result_baseline_costs = COST_MACHINE * (EXTRA_MACHINES_ONE + 
-                                        EXTRA_MACHINES_TWO + 
-                                        EXTRA_MACHINES_THREE)
-
-result_marketing_penalty = ((result_average_times - MKT_PROMISE > 0) * \
-                            (result_average_times - MKT_PROMISE)).sum().values[0] * COST_MKT
-                            
-result_profit = result_product_profit - result_baseline_costs - result_marketing_penalty
+    curves = {}
+    truncation = {}
+    past_limit = []
+    for name, values in series.items():
+        # The last points are dropped as the toys started there are not done yet
+        curve = ensemble_mean(values)[:n_points - WELCH_WINDOW]
+        curves[name] = welch_moving_average(curve, WELCH_WINDOW)
+        curve = pd.Series(curve).ffill().bfill().values
+        d = mser_truncation(curve)
+        if len(curve) >= 4 and d > MSER_LIMIT * len(curve):
+            past_limit.append(name)
+        truncation[name] = d * WELCH_BIN
     
-############################################################
-# Display Results
-print("")
-print("Simulation complete")
-print("")
-printRunParameters(run_params)   
-print("")
-print("Customers:            %6d" % len(toy_list))
-print("Tallied Customers:    %6d" % len(finished_list))
-
-print("\nAverage Times:")
-print(result_average_times)
-
-print("\nThroughput Counts:")
-print(result_counts)
-print("Percent Exceeding Marketing Promise {:5.1f}%".format(result_percent_exceeding_marketing_promise*100))
-
-print("\nFinancial Results:")
-print ("Product Gross Profit:    ${:11.2f}".format(result_product_profit))
-print ("Fixed Costs - Machines:  ${:11.2f}".format(result_baseline_costs))
-print ("Marketing Penalty:       ${:11.2f}".format(result_marketing_penalty))
-print ("------------------------   ----------")
-print ("Overall Profit:          ${:11.2f}".format(result_profit))
+    recommended = max(truncation.values())
+    if past_limit:
+        # MSER at or near its cap is its failure signal, not a warm-up
+        print("WARNING: MSER truncation of %s%s is past %.0f%% of the run, "
+              "using run_params.warm_up_time = %d"
+              % (', '.join(past_limit), '' if label is None else ' for ' + label,
+                 MSER_LIMIT * 100, run_params.warm_up_time))
+        recommended = run_params.warm_up_time
+    
+    curves = pd.DataFrame(curves, index=np.arange(len(curves['Total Time'])) * WELCH_BIN)
+    curves.index.name = 'Time'
+    return {'curves': curves, 'truncation': truncation, 'past_limit': past_limit,
+            'recommended': recommended}
+
+def print_warm_up(analysis):
+    """Prints the truncation point of every Welch curve"""
+    print("\nWarm-up Analysis (MSER on the cross-replication mean curves):")
+    for name, time in analysis['truncation'].items():
+        print("  %-20s %6.1f%s" % (name, time, 
+                                   '  (past MSER_LIMIT)' if name in analysis['past_limit'] else ''))
+    print("Recommended warm-up time: %.1f (run_params.warm_up_time = %d%s)" % 
+          (analysis['recommended'], run_params.warm_up_time,
+           ', used as a fallback' if analysis['past_limit'] else ''))
+
+def plot_warm_up(analysis):
+    """Plots the Welch curves with the recommended warm-up"""
+    fig, axes = plt.subplots(2, 1, sharex=True)
+    analysis['curves'][['Total Time']].plot(ax=axes[0])
+    axes[0].set_title("Welch's moving average (window %d)" % WELCH_WINDOW)
+    analysis['curves'].drop(columns=['Total Time']).plot(ax=axes[1])
+    for ax in axes:
+        ax.axvline(analysis['recommended'], color='black', linestyle='--')
+    axes[1].set_xlabel('Time (%s)' % run_params.time_units.value)
+    plt.show()
+
+def summarize_results(toy_tally, decisions, warm_up_time=None):
+    """Tallies to KPIs for one decision vector (all replications)
+       warm_up_time = toys starting at or before are dropped, 
+                      run_params.warm_up_time by default"""
+    if warm_up_time is None:
+        warm_up_time = run_params.warm_up_time
+
+    all_df = pd.DataFrame(toy_tally, columns=TOY_COLUMNS)
+    df = all_df[(all_df['Status'] == 'Done') & 
+                (all_df['Start Time'] > warm_up_time)]
+    
+    results = {}
+    results['df'] = df
+    results['warm_up_time'] = warm_up_time
+    results['customers'] = len(all_df)
+    exceeding = df[df['Total Time'] > MKT_PROMISE]['Name'].count()
+    results['percent_exceeding_marketing_promise'] = exceeding / df['Name'].count()
+    
+    results['average_times'] = df[['Type','Total Time']].groupby(by=['Type']).mean()
+    results['counts'] = df[['Name','Type']].groupby(by=['Type']).count()
+    
+    # Scaled to the active time of run_params (one year), so a different 
+    # warm-up does not change the length of the period the profit covers
+    active_time_scale = ((run_params.run_time - run_params.warm_up_time) / 
+                         (run_params.run_time - warm_up_time))
+    results['product_profit'] = df['Profit'].sum() / run_params.replications * active_time_scale
+
+    results['baseline_costs'] = COST_MACHINE * (decisions.extra_machines_one + 
+                                                decisions.extra_machines_two + 
+                                                decisions.extra_machines_three)
+
+    average_times = results['average_times']
+    results['marketing_penalty'] = ((average_times - MKT_PROMISE > 0) * \
+                                    (average_times - MKT_PROMISE)).sum().values[0] * COST_MKT
+                            
+    results['profit'] = (results['product_profit'] - results['baseline_costs'] -
+                         results['marketing_penalty'])
+    return results
+
+def replication_kpis(summary):
+    """KPIs of every replication from the toys tallied by summarize_results
+       returns a list of dicts in replication order"""
+    df = summary['df']
+    active_time_scale = ((run_params.run_time - run_params.warm_up_time) / 
+                         (run_params.run_time - summary['warm_up_time']))
+    replication = df[' Replication']
+    kpis = pd.DataFrame({'Total Time': df['Total Time'].groupby(replication).mean(),
+                         '% Exceeding Promise': (df['Total Time'] > MKT_PROMISE)
+                                                .groupby(replication).mean() * 100,
+                         'Throughput': df['Total Time'].groupby(replication).count(),
+                         'Product Profit': (df['Profit'].groupby(replication).sum() *
+                                            active_time_scale)})
+    return kpis.sort_index().to_dict('records')
+
+def save_experiment(decision_summaries):
+    """Writes a run to EXPERIMENT_DB
+       decision_summaries = list of (Decisions, summarize_results) pairs"""
+    store = ExperimentStore(EXPERIMENT_DB)
+    run_id = store.start_run(run_params.problem_name, run_params, globals())
+    for decisions, summary in decision_summaries:
+        store.add_replications(run_id, decisions.label(), replication_kpis(summary))
+        store.add_summary(run_id, decisions.label(),
+                          {'Profit': summary['profit'],
+                           'Product Profit': summary['product_profit'],
+                           'Fixed Costs': summary['baseline_costs'],
+                           'Marketing Penalty': summary['marketing_penalty'],
+                           '% Exceeding Promise':
+                               summary['percent_exceeding_marketing_promise'] * 100,
+                           'Warm-up': summary['warm_up_time']})
+    store.close()
+    return run_id
+
+def run_sweep(decision_list):
+    """Runs every decision vector with all replications on the process pool
+       returns one row per decision vector"""
+    results = run_sweep_tasks(run_replication, [(d,) for d in decision_list],
+                              run_params.replications, run_params.random_seed,
+                              run_params.workers, cache=result_cache)
+    rows = []
+    summaries = []
+    fallbacks = []
+    for decisions, replication_results in zip(decision_list, results):
+        warm_up_time = None
+        if AUTO_WARM_UP:
+            analysis = warm_up_analysis(replication_results, decisions.label())
+            warm_up_time = analysis['recommended']
+            fallbacks.append(bool(analysis['past_limit']))
+        summary = summarize_results(all_toy_tallies(replication_results, decisions),
+                                    decisions, warm_up_time)
+        rows.append(decisions.as_list() + [summary['warm_up_time'], 
+                                           summary['profit'],
+                                           summary['marketing_penalty'],
+                                           summary['percent_exceeding_marketing_promise'] * 100])
+        summaries.append((decisions, summary))
+
+    if EXPERIMENT_DB is not None:
+        save_experiment(summaries)
+    sweep_df = pd.DataFrame(rows, columns=DECISION_COLUMNS + ['Warm-up','Profit',
+                                                              'Marketing Penalty',
+                                                              '% Exceeding Promise'])
+    if AUTO_WARM_UP:
+        sweep_df.insert(len(DECISION_COLUMNS) + 1, 'Warm-up Fallback', fallbacks)
+    if NETWORK_CHECK:
+        sweep_df['Analytic Profit'] = network_approximation(decision_list)['Profit'].values
+    return sweep_df
+
+def print_results(summary):
+    """Prints the KPIs of a single decision vector"""
+    print("")
+    print("Simulation complete")
+    print("")
+    printRunParameters(run_params)   
+    print("")
+    print("Warm-up Time Used:    %6.1f" % summary['warm_up_time'])
+    print("Customers:            %6d" % summary['customers'])
+    print("Tallied Customers:    %6d" % len(summary['df']))
+
+    print("\nAverage Times:")
+    print(summary['average_times'])
+
+    print("\nThroughput Counts:")
+    print(summary['counts'])
+    print("Percent Exceeding Marketing Promise {:5.1f}%"
+          .format(summary['percent_exceeding_marketing_promise']*100))
+
+    print("\nFinancial Results:")
+    print ("Product Gross Profit:    ${:11.2f}".format(summary['product_profit']))
+    print ("Fixed Costs - Machines:  ${:11.2f}".format(summary['baseline_costs']))
+    print ("Marketing Penalty:       ${:11.2f}".format(summary['marketing_penalty']))
+    print ("------------------------   ----------")
+    print ("Overall Profit:          ${:11.2f}".format(summary['profit']))
+
+def print_sweep(sweep_df):
+    """Prints one row per decision vector, best profit first"""
+    print("")
+    print("Sweep complete")
+    print("")
+    printRunParameters(run_params)
+    print("")
+    print("Decision vectors:     %6d" % len(sweep_df))
+    print("")
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(sweep_df.sort_values('Profit', ascending=False)
+                      .to_string(index=False, float_format='{:.1f}'.format))
 
 ############################################################
-# Finished
-print("\nProgram Complete - END")
+# Run Model
+
+if __name__ == '__main__':
+    print("Starting Model: ", run_params.problem_name)
+    if CHECKPOINT_DIR is not None and EXPORT_DIR is None:
+        result_cache = Checkpoint(CHECKPOINT_DIR, RESUME)
+    elif RESULT_CACHE_DIR is not None and EXPORT_DIR is None:
+        result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES)
+
+    if SWEEP_GRID is not None or SWEEP_DECISIONS is not None:
+        # All decision vectors x replications share one process pool
+        decision_list = list(SWEEP_DECISIONS or [])
+        if SWEEP_GRID is not None:
+            decision_list += sweep_decisions(SWEEP_GRID)
+        sweep_df = run_sweep(decision_list)
+        print_sweep(sweep_df)
+    else:
+        decisions = Decisions()
+        results = run_replications(run_replication, run_params.replications,
+                                   run_params.random_seed, run_params.workers, 
+                                   args=(decisions,), cache=result_cache)
+        warm_up_time = None
+        if WARM_UP_ANALYSIS or AUTO_WARM_UP:
+            analysis = warm_up_analysis(results)
+            if AUTO_WARM_UP:
+                warm_up_time = analysis['recommended']
+        
+        summary = summarize_results(all_toy_tallies(results, decisions),
+                                    decisions, warm_up_time)
+        df = summary['df']
+        print_results(summary)
+        if NETWORK_CHECK:
+            print_network_check(decisions, summary)
+        if EXPERIMENT_DB is not None:
+            save_experiment([(decisions, summary)])
+        
+        if WARM_UP_ANALYSIS or AUTO_WARM_UP:
+            print_warm_up(analysis)
+        if WARM_UP_ANALYSIS:
+            plot_warm_up(analysis)
+
+    ############################################################
+    # Finished
+    print("\nProgram Complete - END")